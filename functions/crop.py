@@ -21,6 +21,11 @@ def crop_rec(
     detected. The end of the longest one of those two recordings
     is also cropped, to have the same duration for the two recordings.
     The two cropped recordings are saved as .csv files.
+    The artefact times can be fractional (see artefact.refine_onsets): the
+    intracerebral recording is cropped at a whole sample, and the part of
+    a sample by which it misses the intended start is carried over to the
+    start of the external recording (which has a higher sampling frequency),
+    so that the alignment keeps the precision of the artefact times.
 
     Inputs:
         - LFP_array (np.ndarray with shape: (x, y)): the intracerebral recording 
@@ -72,7 +77,12 @@ def crop_rec(
     LFP_df = pd.DataFrame(LFP_array) # convert np.ndarray to dataframe
     LFP_df_transposed = pd.DataFrame.transpose(LFP_df) # invert rows and columns
 
-    LFP_df_offset = LFP_df_transposed.truncate(before=index_start_LFP) # remove all rows before first artefact
+    # first whole sample at or after the intended start (rounded to avoid
+    # floating point errors), and delay between this sample and the intended start
+    index_start_LFP_sample = int(np.ceil(np.round(index_start_LFP, 6)))
+    delay_start_LFP = (index_start_LFP_sample - index_start_LFP) / sf_LFP
+
+    LFP_df_offset = LFP_df_transposed.truncate(before=index_start_LFP_sample) # remove all rows before first artefact
     LFP_df_offset = LFP_df_offset.reset_index(drop=True) # reset indexes
 
 
@@ -80,13 +90,18 @@ def crop_rec(
     # Crop beginning of external recordings 1s before first artefact:
 
     # find the index of the row corresponding to 1 second before first artefact
-    time_start_external = (art_time_BIP[0])-1
+    # (delayed as the start of the LFP recording)
+    time_start_external = (art_time_BIP[0])-1 + delay_start_LFP
     index_start_external = time_start_external*sf_external
+    index_start_external_sample = int(np.round(index_start_external))
+    residual = (index_start_external_sample - index_start_external) / sf_external
+    if abs(residual) > 1e-9:
+        print(f'Residual misalignment of the cropped recordings: {residual*1000:.3f} ms')
 
     external_df = pd.DataFrame(external_file) # convert np.ndarray to dataframe
     external_df_transposed = pd.DataFrame.transpose(external_df) # invert rows and columns
 
-    external_df_offset = external_df_transposed.truncate(before=index_start_external) # remove all rows before first artefact
+    external_df_offset = external_df_transposed.truncate(before=index_start_external_sample) # remove all rows before first artefact
     external_df_offset = external_df_offset.reset_index(drop=True) # reset indexes
 
     #### Check which recording is the longest, and crop it to give it the same duration as the other one:
@@ -0,0 +1,175 @@
+"""
+On-disk cache of decoded external recordings
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+
+HASH_BYTES = 1024 * 1024  # bytes hashed at the beginning and end of each file
+STALE_TMP_SECONDS = 3600  # unfinished entries older than this are removed (crashed saves)
+
+
+
+def cache_key(
+    filename: str
+):
+    """
+    Function that computes the key identifying a recording in the cache.
+    The key combines the absolute path, the size and the modification
+    time of the file with a hash of its content (the first and last MB,
+    which contain the header, the channel descriptions and the final
+    data blocks).
+
+    Inputs:
+        - filename: path to the recording
+
+    Returns:
+        - key (str): hexadecimal digest
+    """
+
+    stat = os.stat(filename)
+    h = hashlib.sha1()
+    h.update(os.path.abspath(filename).encode('utf-8'))
+    h.update(str(stat.st_size).encode('ascii'))
+    h.update(str(stat.st_mtime_ns).encode('ascii'))
+    with open(filename, 'rb') as f:
+        h.update(f.read(HASH_BYTES))
+        if stat.st_size > HASH_BYTES:
+            f.seek(max(HASH_BYTES, stat.st_size - HASH_BYTES))
+            h.update(f.read(HASH_BYTES))
+
+    return h.hexdigest()
+
+
+
+def load_from_cache(
+    filename: str,
+    cache_dir: str
+):
+    """
+    Function that returns the decoded samples of a recording if they
+    are in the cache. The samples are memory-mapped, not read into memory.
+
+    Inputs:
+        - filename: path to the recording
+        - cache_dir: the cache folder
+
+    Returns:
+        - samples (np.memmap with shape: (x, y)) or None if the recording
+            is not in the cache
+        - metadata (dict) with the channel names and units, or None
+    """
+
+    entry = os.path.join(cache_dir, cache_key(filename))
+    samples_path = os.path.join(entry, 'samples.npy')
+    metadata_path = os.path.join(entry, 'metadata.json')
+    if not (os.path.isfile(samples_path) and os.path.isfile(metadata_path)):
+        return None, None
+
+    with open(metadata_path, 'r') as f:
+        metadata = json.load(f)
+    samples = np.load(samples_path, mmap_mode='r')
+
+    # mark the entry as recently used for the LRU eviction
+    os.utime(metadata_path)
+
+    return samples, metadata
+
+
+
+def save_to_cache(
+    filename: str,
+    samples: np.ndarray,
+    metadata: dict,
+    cache_dir: str,
+    max_size: float = 20e9
+):
+    """
+    Function that stores the decoded samples of a recording and its
+    channel metadata in the cache, then evicts the least recently used
+    entries until the cache is smaller than max_size.
+    The entry is written in a uniquely named temporary folder and then 
+    renamed, so that processes saving the same recording at the same time
+    do not write into the same files (the first one to finish is kept).
+
+    Inputs:
+        - filename: path to the recording
+        - samples (np.ndarray with shape: (x, y)): the decoded recording
+            containing all recorded channels (x channels, y datapoints)
+        - metadata (dict): channel names, units and any other JSON
+            serialisable information about the recording
+        - cache_dir: the cache folder
+        - max_size: maximum size of the cache folder in bytes (default 20GB)
+    """
+
+    key = cache_key(filename)
+    entry = os.path.join(cache_dir, key)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_entry = tempfile.mkdtemp(prefix=key + '.', suffix='.tmp', dir=cache_dir)
+
+    np.save(os.path.join(tmp_entry, 'samples.npy'), np.ascontiguousarray(samples))
+    with open(os.path.join(tmp_entry, 'metadata.json'), 'w') as f:
+        json.dump(dict(metadata, filename=os.path.abspath(filename)), f, indent=4, default=str)
+
+    if os.path.isdir(entry) and not os.path.isfile(os.path.join(entry, 'metadata.json')):
+        # incomplete entry (interrupted eviction)
+        shutil.rmtree(entry, ignore_errors=True)
+    try:
+        os.replace(tmp_entry, entry)
+    except OSError:
+        if not os.path.isdir(entry):
+            raise
+        # the entry was saved by another process in the meantime, with the
+        # same key and therefore the same content
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+
+    evict_cache(cache_dir, max_size, keep=key)
+
+
+
+def evict_cache(
+    cache_dir: str,
+    max_size: float,
+    keep: str = None
+):
+    """
+    Function that removes the least recently used entries of the cache
+    until its total size is below max_size (in bytes). The entry named
+    keep is never removed. Unfinished entries (.tmp folders) which have
+    not been written to for STALE_TMP_SECONDS are left over by crashed
+    saves, and are removed first.
+    """
+
+    entries = []
+    for key in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, key)
+        # entries can be renamed or removed by other processes meanwhile
+        try:
+            files = [os.path.join(entry, f) for f in os.listdir(entry)]
+            if key.endswith('.tmp'):
+                last_written = max([os.path.getmtime(entry)] + [os.path.getmtime(f) for f in files])
+                if time.time() - last_written > STALE_TMP_SECONDS:
+                    shutil.rmtree(entry, ignore_errors=True)
+                continue
+            metadata_path = os.path.join(entry, 'metadata.json')
+            if not os.path.isfile(metadata_path):
+                continue
+            size = sum(os.path.getsize(f) for f in files)
+            entries.append((os.path.getmtime(metadata_path), key, size))
+        except OSError:
+            continue
+
+    total_size = sum(size for _, _, size in entries)
+    for last_used, key, size in sorted(entries):
+        if total_size <= max_size:
+            break
+        if key == keep:
+            continue
+        shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+        total_size -= size
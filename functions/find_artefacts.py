@@ -1,8 +1,28 @@
 import numpy as np
-from scipy.signal import find_peaks
+from scipy.signal import find_peaks, oaconvolve, resample_poly
+from scipy import fft
 from itertools import compress
+from collections import deque
 import os
 import json
+from concurrent.futures import ThreadPoolExecutor
+
+
+# kernels longer than this are correlated with the signal by FFT
+# (overlap-add) instead of direct summation
+DIRECT_CORRELATION_MAX_KERNEL = 128
+
+# length of the blocks (in seconds) of the coarse pass in coarse-to-fine
+# detection: blocks which cannot contain an artefact are skipped
+COARSE_BLOCK_SECONDS = 0.1
+
+# kernels mimicking the LFP stim-artefact:
+# kernel 1 only searches for the steep decrease
+# kernel 2 is more custom and takes into account the steep decrease and slow recover
+LFP_KERNELS = {
+    '1': np.array([1, -1]),
+    '2': np.array([1, 0, -1] + list(np.linspace(-1, 0, 20)))
+}
 
 
 # Detection of artefacts in TMSi
@@ -11,7 +31,8 @@ def find_external_sync_artefact(
     data: np.ndarray, 
     sf_external: int,
     ignore_first_seconds_external=None, 
-    consider_first_seconds_external=None
+    consider_first_seconds_external=None,
+    coarse_to_fine: bool = False
 ):
 
     """ 
@@ -21,7 +42,9 @@ def find_external_sync_artefact(
     start in stim-off, and typically short pulses are given 
     (without ramping). 
     This function uses a fixed threshold ('thresh_external'), which
-    has to be adapted to each data recorder in the config.json file. 
+    has to be adapted to each data recorder in the config.json file,
+    or is estimated from the signal if 'thresh_external' is "auto"
+    (see estimate_external_threshold). 
     The signal must be pre-processed previously with a high-pass 
     Butterworth filter (1Hz) to ensure removal of slow drifts
     and offset around 0.
@@ -35,6 +58,10 @@ def find_external_sync_artefact(
         - consider_first_seconds_external : if given, only artefacts in
             the first (and last) n-seconds are considered (in case the
             recording is StimON, it ignores the other amplitude changes)
+        - coarse_to_fine: if True, the minimum of each block of 
+            COARSE_BLOCK_SECONDS is computed first, and the sample-wise
+            search only runs inside the blocks which reach thresh_BIP
+            (faster for long recordings, same result)
     
     Returns:
         - index_artefact_start_external : a list containing the indexes of each
@@ -49,74 +76,69 @@ def find_external_sync_artefact(
     with open(os.path.join(json_path, json_filename), 'r') as f:
         loaded_dict =  json.load(f)
 
-    #initialize variables (lists and state)
-    index_artefact_start_external = []
+    #initialize stim state
     stimON = False
 
     if not loaded_dict['thresh_external']:
             thresh_BIP = -0.001     #default threshold, works with TMSi SAGA sampling at 4000Hz 
-    else:
+    elif loaded_dict['thresh_external'] != 'auto':
         thresh_BIP = loaded_dict['thresh_external']
 
     start_index = 0
     stop_index = len(data)-2
 
     if ignore_first_seconds_external:
-        start_index = ignore_first_seconds_external*sf_external
+        start_index = int(ignore_first_seconds_external*sf_external)
 
     if consider_first_seconds_external:
-        stop_index = consider_first_seconds_external*sf_external
+        stop_index = int(consider_first_seconds_external*sf_external)
 
     # check polarity of artefacts before detection:
     # to be properly detected in external channel, artefacts have to look like a downward deflection 
     # (they are more negative than positive). If for some reason the data recorder picks up
     # the artefact as an upward deflection instead, then the signal has to be inverted before detecting artefacts.
-    if abs(max(data)) > abs(min(data)):
+    if abs(np.max(data)) > abs(np.min(data)):
         print('external signal is reversed')
         data = data * -1
 
-    #start looking at each value one by one and append the timepoint to the list depending on the state and if thresh_BIP is crossed
-    for q in range(start_index,stop_index):
-        if ((stimON == False) 
-                and (data[q] <= thresh_BIP) 
-                and (data[q] < data[q + 1]) 
-                and (data[q] < data[q - 1])):
-            if q >= 0.2*sf_external:
-                index_artefact_start_external.append(q)
-                stimON = True
-                q = q + 1
-            elif q < 0.2*sf_external:
-                print ('External recording started with stim already ON. Ignoring first artefact')
-                stimON = True
-                q = q + 1
-        if (stimON
-                and (data[q] <= thresh_BIP) 
-                and (data[q] < data[q + 1]) 
-                and (data[q] < data[q - 1])):
-            if (all(data[(q + 2):(q + int(0.5*sf_external))] > thresh_BIP)):
-                stimON = False
-                q = q + 1
-        else:
-            q = q + 1
+    if loaded_dict['thresh_external'] == 'auto':
+        thresh_BIP = estimate_external_threshold(data)
+        print(f'Estimated external threshold: {thresh_BIP:.6g}')
+
+    quiet_window = int(0.5*sf_external)
+    if coarse_to_fine:
+        below = _samples_below(
+            data, thresh_BIP, block_size=max(int(COARSE_BLOCK_SECONDS*sf_external), 1)
+        )
+        next_below = None
+    else:
+        below = _samples_below(data, thresh_BIP)
+        next_below = _next_below_index(data, thresh_BIP)
+
+    # find all timepoints where thresh_BIP is crossed at a local minimum, then
+    # follow the stim state from one of these candidates to the next
+    candidates = _find_local_minima_below(data, below, start_index, stop_index)
+    artefact_starts, stimON = _resolve_stim_transitions(
+        candidates, 
+        _quiet_windows(candidates, quiet_window, len(data), next_below, below), 
+        stimON
+    )
+    if np.any(artefact_starts < 0.2*sf_external):
+        print ('External recording started with stim already ON. Ignoring first artefact')
+    index_artefact_start_external = artefact_starts[
+        artefact_starts >= 0.2*sf_external
+    ].tolist()
 
     if consider_first_seconds_external:
-        for q in range(len(data) - stop_index, len(data) - 2):
-            if (not stimON
-                    and (data[q] <= thresh_BIP) 
-                    and (data[q] < data[q + 1]) 
-                    and (data[q] < data[q - 1])):
-                index_artefact_start_external.append(q)
-                stimON = True
-                q = q + 1
-            if (stimON 
-                    and (data[q] <= thresh_BIP) 
-                    and (data[q] < data[q + 1]) 
-                    and (data[q] < data[q - 1])):
-                if (all(data[(q + 2):(q + int(0.5*sf_external))] > thresh_BIP)):
-                    stimON = False
-                    q = q + 1
-            else:
-                q = q + 1
+        candidates = _find_local_minima_below(
+            data, below, len(data) - stop_index, len(data) - 2
+        )
+        artefact_starts, stimON = _resolve_stim_transitions(
+            candidates, 
+            _quiet_windows(candidates, quiet_window, len(data), next_below, below), 
+            stimON
+        )
+        index_artefact_start_external.extend(artefact_starts.tolist())
 
 
     return index_artefact_start_external
@@ -125,6 +147,457 @@ def find_external_sync_artefact(
 
 
 
+def external_head_tail_bounds(
+    n_samples: int,
+    sf_external: int,
+    consider_first_seconds_external
+):
+    """
+    Function that returns the segments of the external channel which are
+    needed by find_external_sync_artefact when consider_first_seconds_external
+    is given: the head data[:head_stop] (the first n-seconds and the quiet
+    window after them) and the tail data[tail_start:] (the last n-seconds 
+    and the sample before them). If they overlap, the head is the whole
+    recording and the tail is empty.
+
+    Inputs:
+        - n_samples (int): length of the external channel
+        - sf_external (int): sampling frequency of external recording
+        - consider_first_seconds_external: the n-seconds at the beginning
+            and at the end of the recording in which artefacts are considered
+
+    Returns:
+        - head_stop (int), tail_start (int)
+    """
+
+    stop_index = int(consider_first_seconds_external*sf_external)
+    head_stop = stop_index + int(0.5*sf_external)
+    tail_start = n_samples - stop_index - 1
+    if head_stop >= tail_start:
+        return n_samples, n_samples
+
+    return head_stop, tail_start
+
+
+
+def find_external_sync_artefact_head_tail(
+    head: np.ndarray,
+    tail: np.ndarray,
+    sf_external: int,
+    n_samples: int,
+    consider_first_seconds_external,
+    ignore_first_seconds_external=None,
+    coarse_to_fine: bool = False
+):
+    """
+    Function that runs find_external_sync_artefact with 
+    consider_first_seconds_external on the head and tail segments of the
+    external channel only (see external_head_tail_bounds), e.g. read and
+    filtered with loading._load_TMSi_artefact_head_tail, so that StimOn 
+    sessions cost the same whatever the recording length. 
+    The artefacts are the same as with the whole channel, except that the
+    polarity check (and the "auto" threshold) only use the head and tail.
+
+    Inputs:
+        - head: the filtered external channel from 0 to head_stop
+        - tail: the filtered external channel from tail_start to n_samples
+        - sf_external (int): sampling frequency of external recording
+        - n_samples (int): length of the whole external channel
+        - consider_first_seconds_external : only artefacts in the first 
+            (and last) n-seconds are considered
+        - ignore_first_seconds_external, coarse_to_fine: see 
+            find_external_sync_artefact
+    
+    Returns:
+        - index_artefact_start_external : a list containing the indexes of each
+            artefact start detected (in the whole recording)
+    """
+
+    head_stop, tail_start = external_head_tail_bounds(
+        n_samples, sf_external, consider_first_seconds_external
+    )
+    assert len(head) == head_stop and len(tail) == n_samples - tail_start, (
+        'head and tail do not match external_head_tail_bounds'
+    )
+
+    # the tail pass of find_external_sync_artefact starts stop_index samples
+    # before the end of the data, so it only uses the tail of the concatenation
+    index_artefact_start_external = find_external_sync_artefact(
+        data=np.concatenate((head, tail)),
+        sf_external=sf_external,
+        ignore_first_seconds_external=ignore_first_seconds_external,
+        consider_first_seconds_external=consider_first_seconds_external,
+        coarse_to_fine=coarse_to_fine
+    )
+    tail_offset = tail_start - head_stop
+
+    return [
+        i if i < head_stop else i + tail_offset 
+        for i in index_artefact_start_external
+    ]
+
+
+
+def estimate_external_threshold(
+    data: np.ndarray,
+    n_mad: float = 8,
+    depth_fraction: float = .5
+):
+    """
+    Function that estimates the threshold of find_external_sync_artefact
+    from robust statistics of the signal, so that it does not have to be
+    tuned for each data recorder. The signal is expected to be filtered
+    (see preprocessing.filtering) and its artefacts to be downward 
+    deflections.
+    The noise level is given by the median absolute deviation (MAD) of the
+    signal, which is not influenced by the short artefacts. The threshold
+    is then the lowest of:
+        - the noise floor: n_mad times the noise level below the median
+        - depth_fraction of the typical artefact depth: the median of all
+            local minima below the noise floor
+    
+    Inputs:
+        - data: single external channel as np.ndarray (from bipolar electrode)
+        - n_mad: distance of the noise floor to the median, in MAD units
+            (scaled to the std dev of gaussian noise)
+        - depth_fraction: fraction of the typical artefact depth 
+
+    Returns:
+        - thresh_BIP (float): the estimated threshold
+    """
+
+    center, noise_level, artefact_minima = _external_noise_statistics(data, n_mad)
+    noise_floor = center - n_mad * noise_level
+    if len(artefact_minima) == 0:
+        return float(noise_floor)
+
+    artefact_depth = np.median(artefact_minima) - center
+
+    return float(min(noise_floor, center + depth_fraction * artefact_depth))
+
+
+
+def _external_noise_statistics(
+    data: np.ndarray,
+    n_mad: float = 8
+):
+    """
+    Function that returns the median of the signal, its noise level (median
+    absolute deviation scaled to the std dev of gaussian noise), and the
+    local minima deeper than n_mad times the noise level (the artefacts).
+    """
+
+    center = np.median(data)
+    noise_level = 1.4826 * np.median(np.abs(data - center))
+    noise_floor = center - n_mad * noise_level
+
+    is_minimum = (
+        (data[1:-1] < noise_floor) & (data[1:-1] < data[:-2]) & (data[1:-1] <= data[2:])
+    )
+
+    return center, noise_level, data[1:-1][is_minimum]
+
+
+
+def rank_external_channels(
+    filtered_array: np.ndarray,
+    sf_external: int,
+    ch_names: list = None,
+    n_workers: int = None,
+    exclude: tuple = ('COUNTER', 'STATUS')
+):
+    """
+    Function that ranks all channels of an external recording by how
+    clearly they carry the on/off pattern of the stimulation, to find the
+    channel recorded with the bipolar electrode without knowing its name.
+    On each channel (in parallel), the polarity is checked and the
+    threshold of find_external_sync_artefact is estimated (see 
+    estimate_external_threshold), then the stimulation onsets are detected.
+    The score of a channel is the SNR of its artefacts (depth of the 
+    typical artefact divided by the noise level) multiplied by the log of
+    the number of artefact pulses per stimulation onset: stimulation gives
+    trains of pulses, while isolated transients give one pulse per onset
+    (score 0).
+
+    Inputs:
+        - filtered_array (np.ndarray with shape: (x, y)): the external
+            recording with all channels, filtered (see preprocessing.filtering,
+            which filters all channels at once)
+        - sf_external (int): sampling frequency of external recording
+        - ch_names (list of x names): names of the channels, channels whose
+            name contains one of the exclude strings are left out
+        - n_workers (int): number of threads, defaults to the number of CPUs
+        - exclude: tuple of (upper case) strings identifying non-signal channels
+
+    Returns:
+        - ranking: list of dicts (one per channel, best first) containing 
+            'index', 'name', 'score', 'snr', 'pulses_per_onset', 'n_onsets', 
+            'thresh_external', 'reversed' and 'onsets'
+    """
+
+    if ch_names is None:
+        ch_names = [str(i) for i in range(len(filtered_array))]
+    channels = [
+        i for i, ch_name in enumerate(ch_names)
+        if not any(e in str(ch_name).upper() for e in exclude)
+    ]
+
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        ranking = list(pool.map(
+            lambda ch: _external_channel_score(filtered_array[ch], sf_external),
+            channels
+        ))
+    for ch, channel_score in zip(channels, ranking):
+        channel_score.update(index=ch, name=ch_names[ch])
+
+    return sorted(ranking, key=lambda channel_score: -channel_score['score'])
+
+
+
+def _external_channel_score(
+    data: np.ndarray,
+    sf_external: int
+):
+    """
+    Function that detects the stimulation onsets of one filtered external
+    channel with an estimated threshold, and scores how clearly the channel
+    carries the stimulation artefacts (see rank_external_channels).
+    """
+
+    reversed_signal = bool(abs(np.max(data)) > abs(np.min(data)))
+    if reversed_signal:
+        data = data * -1
+
+    thresh_BIP = estimate_external_threshold(data)
+    center, noise_level, artefact_minima = _external_noise_statistics(data)
+
+    below = _samples_below(data, thresh_BIP)
+    candidates = _find_local_minima_below(data, below, 0, len(data) - 2)
+    quiet = _quiet_windows(
+        candidates, int(0.5*sf_external), len(data), 
+        _next_below_index(data, thresh_BIP)
+    )
+    onsets, _ = _resolve_stim_transitions(candidates, quiet)
+
+    if len(onsets) == 0 or len(artefact_minima) == 0 or noise_level == 0:
+        snr, pulses_per_onset, score = 0, 0, 0
+    else:
+        snr = (center - np.median(artefact_minima)) / noise_level
+        pulses_per_onset = len(candidates) / len(onsets)
+        score = snr * np.log(pulses_per_onset)
+
+    return {
+        'score': score,
+        'snr': snr,
+        'pulses_per_onset': pulses_per_onset,
+        'n_onsets': len(onsets),
+        'thresh_external': thresh_BIP,
+        'reversed': reversed_signal,
+        'onsets': onsets.tolist()
+    }
+
+
+
+def _samples_below(
+    data: np.ndarray,
+    thresh_BIP: float,
+    block_size: int = None
+):
+    """
+    Function that returns the (sorted) indexes of all samples which are
+    not above thresh_BIP.
+    If block_size is given, the minimum of each block of block_size samples
+    is computed first (coarse pass), and only the blocks whose minimum is
+    not above thresh_BIP are searched sample-wise (fine pass).
+    """
+
+    if block_size is None:
+        return np.flatnonzero(~(data > thresh_BIP))
+
+    block_min = _block_reduce(data, block_size, np.min)
+    selected_blocks = np.flatnonzero(~(block_min > thresh_BIP))
+
+    below = []
+    for first_block, last_block in _consecutive_runs(selected_blocks):
+        start = first_block * block_size
+        stop = min((last_block + 1) * block_size, len(data))
+        below.append(np.flatnonzero(~(data[start:stop] > thresh_BIP)) + start)
+
+    if len(below) == 0:
+        return np.array([], dtype=int)
+
+    return np.concatenate(below)
+
+
+
+def _block_reduce(
+    data: np.ndarray,
+    block_size: int,
+    func
+):
+    """
+    Function that applies func (np.min or np.max) to each block of 
+    block_size samples of the signal (the last block can be shorter),
+    and returns one value per block.
+    """
+
+    n_full_blocks = len(data) // block_size
+    reduced = func(
+        data[:n_full_blocks * block_size].reshape(n_full_blocks, block_size), axis=1
+    )
+    if len(data) > n_full_blocks * block_size:
+        reduced = np.append(reduced, func(data[n_full_blocks * block_size:]))
+
+    return reduced
+
+
+
+def _consecutive_runs(
+    blocks: np.ndarray
+):
+    """
+    Function that groups sorted block indexes into runs of consecutive
+    blocks, and returns a list of (first_block, last_block) tuples.
+    """
+
+    if len(blocks) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(blocks) > 1)
+    firsts = np.concatenate(([blocks[0]], blocks[breaks + 1]))
+    lasts = np.concatenate((blocks[breaks], [blocks[-1]]))
+
+    return list(zip(firsts, lasts))
+
+
+
+def _find_local_minima_below(
+    data: np.ndarray,
+    below: np.ndarray,
+    start_index: int,
+    stop_index: int
+):
+    """
+    Function that returns the indexes q in range(start_index, stop_index)
+    where data[q] <= thresh_BIP and data[q] is a local minimum
+    (data[q] < data[q - 1] and data[q] < data[q + 1]). below contains
+    the indexes of the samples not above thresh_BIP (see _samples_below).
+    """
+
+    stop_index = min(stop_index, len(data) - 1)
+    if stop_index <= start_index:
+        return np.array([], dtype=int)
+
+    below = below[
+        np.searchsorted(below, start_index): np.searchsorted(below, stop_index)
+    ]
+    # data[-1] is used as previous sample of the first timepoint
+    is_minimum = (data[below] < data[below + 1]) & (data[below] < data[below - 1])
+
+    return below[is_minimum]
+
+
+
+def _next_below_index(
+    data: np.ndarray,
+    thresh_BIP: float
+):
+    """
+    Function that returns, for each timepoint i, the index of the first
+    sample at or after i which is not above thresh_BIP (len(data) if there
+    is none). It is computed in one backward pass, and lets the quiet
+    window after any sample be checked in constant time.
+    """
+
+    n = len(data)
+    below_idx = np.where(data > thresh_BIP, n, np.arange(n))
+
+    return np.minimum.accumulate(below_idx[::-1])[::-1]
+
+
+
+def _quiet_windows(
+    candidates: np.ndarray,
+    quiet_window: int,
+    n_samples: int,
+    next_below: np.ndarray = None,
+    below: np.ndarray = None
+):
+    """
+    Function that checks, for each candidate c, if its quiet window 
+    data[c + 2: c + quiet_window] is quiet (all samples above thresh_BIP).
+    With next_below (see _next_below_index), each check is a constant-time
+    lookup. Otherwise (coarse_to_fine, where no full-length array is 
+    allocated), the next sample not above thresh_BIP is searched in the 
+    sorted indexes below (see _samples_below).
+
+    Returns:
+        - quiet: boolean np.ndarray, one value per candidate
+    """
+
+    window_start = candidates + 2
+    window_stop = np.minimum(candidates + quiet_window, n_samples)
+    quiet = np.ones(len(candidates), dtype=bool)
+    non_empty = window_start < window_stop
+    if next_below is not None:
+        next_sample_below = next_below[window_start[non_empty]]
+    else:
+        next_sample_below = np.append(below, n_samples)[
+            np.searchsorted(below, window_start[non_empty])
+        ]
+    quiet[non_empty] = next_sample_below >= window_stop[non_empty]
+
+    return quiet
+
+
+
+def _resolve_stim_transitions(
+    candidates: np.ndarray,
+    quiet: np.ndarray,
+    stimON: bool = False
+):
+    """
+    Function that follows the stim state over the candidate artefacts
+    (local minima below thresh_BIP, in increasing order).
+    A candidate found while stim is OFF is the start of an artefact and
+    switches stim ON. A candidate found while stim is ON and followed by a
+    quiet window (all samples from 2 to quiet_window after it above 
+    thresh_BIP) switches stim OFF. As in the original sample-by-sample loop,
+    the candidate starting an artefact never switches stim OFF itself, even
+    if it is followed by a quiet window (single pulse).
+
+    Inputs:
+        - candidates: np.ndarray of candidate indexes
+        - quiet: boolean np.ndarray, True for the candidates followed by
+            a quiet window (see _quiet_windows)
+        - stimON: stim state before the first candidate
+
+    Returns:
+        - artefact_starts: np.ndarray of the candidates starting an artefact
+        - stimON: stim state after the last candidate
+    """
+
+    if len(candidates) == 0:
+        return candidates, stimON
+
+    # stim is OFF after a candidate if it is quiet and stim was ON before it:
+    # off_before[i + 1] = quiet[i] & ~off_before[i]. A candidate which is not
+    # quiet leaves stim ON, and along a run of quiet candidates the state 
+    # alternates, so it is given by the parity of the position in the run
+    position = np.arange(len(candidates))
+    run_start = quiet & np.concatenate(([True], ~quiet[:-1]))
+    run_first = np.maximum.accumulate(np.where(run_start, position, 0))
+    position_in_run = position - run_first
+    # only a run starting at the first candidate can start with stim OFF
+    starts_off = (not stimON) & quiet[0] & (run_first == 0)
+    stim_off_after = quiet & ((position_in_run % 2 == 0) != starts_off)
+    stim_off_before = np.concatenate(([not stimON], stim_off_after[:-1]))
+
+    return candidates[stim_off_before], not stim_off_after[-1]
+
+
+
+
+
 # Detection of artefacts in LFP
 
 def find_LFP_sync_artefact(
@@ -132,6 +605,9 @@ def find_LFP_sync_artefact(
     sf_LFP,
     use_kernel: str = '1',
     consider_first_seconds_LFP=None,
+    coarse_to_fine: bool = False,
+    search_windows: list = None,
+    head_tail_only: bool = False,
 ):
     """
     Function that finds artefacts caused by
@@ -156,6 +632,19 @@ def find_LFP_sync_artefact(
             In our tests, kernel 2 was the best in 52.7% of the cases.
         - consider_first_seconds_LFP: if given, only artefacts in the first
             (and last) n-seconds are considered
+        - coarse_to_fine: if True, the dot-products are only computed in 
+            the blocks of COARSE_BLOCK_SECONDS where the envelope of the
+            signal allows a peak high enough to be detected (faster for
+            long recordings, same result)
+        - search_windows: if given, list of (start, stop) windows in seconds 
+            (e.g. around the stimulation amplitude changes, see 
+            find_stim_change_windows), the artefacts are only searched
+            inside these windows
+        - head_tail_only: if True and consider_first_seconds_LFP is given,
+            the dot-products are only computed in the first and last 
+            n-seconds (plus 1 second), instead of over the whole recording
+            and filtered afterwards. The normalisation then uses the
+            maximum of these segments only.
     
     Returns:
         - stim_idx: a list with all stim-artefact starts. 
@@ -167,47 +656,649 @@ def find_LFP_sync_artefact(
         loaded_dict =  json.load(f)
 
     
-    signal_inverted = False  # defaults false
-
     # checks correct input for use_kernel variable
-    assert use_kernel in ['1', '2'], 'use_kernel incorrect'
+    assert use_kernel in LFP_KERNELS, 'use_kernel incorrect'
 
-    # kernel 1 only searches for the steep decrease
-    # kernel 2 is more custom and takes into account the steep decrease and slow recover
-    kernels = {'1': np.array([1, -1]),
-               '2': np.array([1, 0, -1] + list(np.linspace(-1, 0, 20)))
-    }
-    ker = kernels[use_kernel]
+    ker = LFP_KERNELS[use_kernel]
     
     # get dot-products between kernel and time-serie snippets
-    res = []  # store results of dot-products
-    for i in np.arange(0, len(lfp_data) - len(ker)):
-        res.append(ker @ lfp_data[i: i + len(ker)])  # calculate dot-product of vectors
-        # the dot-product result is high when the timeseries snippet
-        # is very similar to the kernel
-    res = np.array(res)  # convert list to array
+    # the dot-product result is high when the timeseries snippet
+    # is very similar to the kernel
+    if head_tail_only and consider_first_seconds_LFP and search_windows is None:
+        duration = len(lfp_data) / sf_LFP
+        search_windows = [
+            (0, consider_first_seconds_LFP + 1),
+            (duration - consider_first_seconds_LFP - 1, duration)
+        ]
+
+    if search_windows is not None and len(search_windows) == 0:
+        print('WARNING: no search window given (no stimulation change found),'
+              ' the artefacts are searched in the whole recording')
+        search_windows = None
+
+    search_mask = None
+    if search_windows is not None:
+        windows = _windows_to_index(search_windows, sf_LFP)
+        res = _windowed_kernel_correlation(lfp_data, ker, windows)
+        search_mask = _windows_to_mask(windows, len(res))
+    elif coarse_to_fine:
+        res = _coarse_to_fine_kernel_correlation(
+            lfp_data, ker, 
+            block_size=max(int(COARSE_BLOCK_SECONDS*sf_LFP), 1),
+            exact_samples=int(sf_LFP*30)
+        )
+    else:
+        res = _kernel_correlation(lfp_data, ker)
+
+    stim_idx, _, _ = _detect_LFP_artefacts(
+        res, lfp_data, sf_LFP, consider_first_seconds_LFP, search_mask
+    )
+
+    return stim_idx
+
+
+
+def find_LFP_sync_artefact_kernel_bank(
+    lfp_data: np.ndarray,
+    sf_LFP,
+    kernels: dict = None,
+    consider_first_seconds_LFP=None,
+    search_windows: list = None,
+):
+    """
+    Function that runs the LFP artefact detection of find_LFP_sync_artefact
+    with several kernels at once, and recommends the most suitable one.
+    The dot-products of the built-in (short) kernels are computed directly,
+    as in find_LFP_sync_artefact, and those of long user-defined kernels in
+    a single batched FFT correlation. Each kernel is then scored with the 
+    ratio_max_sd of its dot-products (how much the artefacts stand out) 
+    multiplied by the consistency of the peak heights of its detections 
+    (1 - median absolute deviation / median of the heights, 1 when all 
+    artefacts are equally high) and by the SNR of its detections (median 
+    peak height divided by the noise level of the channel, as in 
+    find_LFP_sync_artefact_best_channel), so that a kernel locked onto 
+    noise peaks does not win.
+
+    Input:
+        - lfp_data: single channel as np.ndarray
+        - sf_LFP (int): sampling frequency of intracranial recording
+        - kernels: dict of kernels (name: np.ndarray), defaults to the two
+            built-in kernels '1' and '2'. User-defined kernels can be added, 
+            e.g. {**LFP_KERNELS, 'custom': np.array([...])}
+        - consider_first_seconds_LFP: if given, only artefacts in the first
+            (and last) n-seconds are considered
+        - search_windows: if given, list of (start, stop) windows in seconds,
+            the artefacts are only searched inside these windows
+    
+    Returns:
+        - detections: dict with, for each kernel name, a dict containing
+            'stim_idx' (list of stim-artefact starts), 'ratio_max_sd', 
+            'height_consistency', 'snr' and 'score'
+        - recommended_kernel: name of the kernel with the highest score
+    """
+
+    if kernels is None:
+        kernels = LFP_KERNELS
+    kernel_names = list(kernels)
+
+    res_bank = _kernel_bank_correlation(
+        lfp_data, [np.asarray(kernels[k]) for k in kernel_names]
+    )
+
+    if search_windows is not None and len(search_windows) == 0:
+        print('WARNING: no search window given (no stimulation change found),'
+              ' the artefacts are searched in the whole recording')
+        search_windows = None
+
+    in_windows = None
+    if search_windows is not None:
+        in_windows = _windows_to_mask(
+            _windows_to_index(search_windows, sf_LFP), len(lfp_data)
+        )
+        res_bank = [res * in_windows[:len(res)] for res in res_bank]
+
+    noise_level = 1.4826 * np.median(np.abs(lfp_data - np.median(lfp_data)))
+
+    detections = {}
+    for kernel_name, res in zip(kernel_names, res_bank):
+        stim_idx, _, ratio_max_sd = _detect_LFP_artefacts(
+            res, lfp_data, sf_LFP, consider_first_seconds_LFP,
+            None if in_windows is None else in_windows[:len(res)]
+        )
+        if len(stim_idx) > 0:
+            abs_heights = np.max(np.abs(_peak_windows(lfp_data, stim_idx)), axis=1)
+            median_height = np.median(abs_heights)
+            height_consistency = max(
+                0, 1 - np.median(np.abs(abs_heights - median_height)) / median_height
+            )
+            snr = median_height / noise_level if noise_level > 0 else np.inf
+        else:
+            height_consistency = 0
+            snr = 0
+        detections[kernel_name] = {
+            'stim_idx': stim_idx,
+            'ratio_max_sd': ratio_max_sd,
+            'height_consistency': height_consistency,
+            'snr': snr,
+            'score': ratio_max_sd * height_consistency * snr if height_consistency > 0 else 0
+        }
+
+    recommended_kernel = max(kernel_names, key=lambda k: detections[k]['score'])
+    print(f'Recommended kernel: {recommended_kernel}')
+
+    return detections, recommended_kernel
+
+
+
+def find_LFP_sync_artefact_template(
+    lfp_data: np.ndarray,
+    sf_LFP,
+    template: np.ndarray = None,
+    use_kernel: str = '2',
+    template_seconds: float = .1,
+    consider_first_seconds_LFP=None,
+):
+    """
+    Function that finds the LFP stim-artefacts with a matched filter: 
+    a template of the artefact learned from the session itself replaces 
+    the hard-coded kernels, which only approximate the real artefact shape
+    (it varies between IPGs and montages).
+    Without template, the artefacts are first detected with use_kernel. 
+    The most consistent detections (peak height within 25% of the median)
+    are averaged into the template (zero mean, scaled to a maximum of 1, 
+    oriented like a non-inverted signal). The template is centered on the
+    artefact start (index len(template) // 2), so that it also contains the
+    signal before the artefact. The detection is then run again with the 
+    template as kernel, correlated by FFT, and the matched-filter peaks are
+    shifted by len(template) // 2 to give the artefact starts.
+    The template can be re-used for later sessions of the same patient
+    (recorded with the same sampling frequency).
+
+    Input:
+        - lfp_data: single channel as np.ndarray
+        - sf_LFP (int): sampling frequency of intracranial recording
+        - template: template returned by a previous call, if None it is 
+            learned from the session
+        - use_kernel: kernel of the initial detection (see LFP_KERNELS)
+        - template_seconds: length of the learned template in seconds
+            (half before and half after the artefact start)
+        - consider_first_seconds_LFP: if given, only artefacts in the first
+            (and last) n-seconds are considered
+    
+    Returns:
+        - stim_idx: a list with all stim-artefact starts
+        - template: the template as np.ndarray (None if no artefact was
+            found by the initial detection or the learned template is not
+            finite)
+    """
+
+    if template is None:
+        # checks correct input for use_kernel variable
+        assert use_kernel in LFP_KERNELS, 'use_kernel incorrect'
+
+        res = _kernel_correlation(lfp_data, LFP_KERNELS[use_kernel])
+        stim_idx, signal_inverted, _ = _detect_LFP_artefacts(
+            res, lfp_data, sf_LFP, consider_first_seconds_LFP
+        )
+        template_length = max(int(template_seconds * sf_LFP), 2)
+        onset_offset = template_length // 2
+        stim_idx = np.array(stim_idx, dtype=int)
+        stim_idx = stim_idx[
+            (stim_idx >= onset_offset) 
+            & (stim_idx - onset_offset + template_length <= len(lfp_data))
+        ]
+        if len(stim_idx) == 0:
+            print('WARNING: no artefacts found to learn the template')
+            return [], None
+
+        # keep the most consistent detections
+        abs_heights = np.max(np.abs(_peak_windows(lfp_data, stim_idx)), axis=1)
+        median_height = np.median(abs_heights)
+        consistent = np.abs(abs_heights - median_height) <= .25 * median_height
+        if np.sum(consistent) >= 2:
+            stim_idx = stim_idx[consistent]
+        else:
+            print('WARNING: the detections are not consistent in height,'
+                  ' the template is learned from all of them')
+
+        # average of the artefacts, centered on the detected indexes
+        artefacts = lfp_data[
+            stim_idx[:, None] - onset_offset + np.arange(template_length)
+        ]
+        template = np.mean(artefacts, axis=0)
+        if signal_inverted:
+            template = template * -1
+        template = template - np.mean(template)
+        if not np.all(np.isfinite(template)) or np.max(np.abs(template)) == 0:
+            print('WARNING: the learned template is flat or not finite')
+            return [], None
+        template = template / np.max(np.abs(template))
+        print(f'Template learned from {len(stim_idx)} artefacts')
+
+    template = np.asarray(template, dtype=float)
+    res = _fft_kernel_correlation(lfp_data, [template])[0]
+    # res[i] matches the template starting at i, i.e. an artefact starting
+    # at i + len(template) // 2
+    res = np.concatenate((np.zeros(len(template) // 2), res))
+    stim_idx, _, _ = _detect_LFP_artefacts(
+        res, lfp_data, sf_LFP, consider_first_seconds_LFP
+    )
+
+    return stim_idx, template
+
+
+
+def find_LFP_sync_artefact_best_channel(
+    LFP_array: np.ndarray,
+    sf_LFP,
+    use_kernel: str = '2',
+    channels: list = None,
+    consider_first_seconds_LFP=None,
+):
+    """
+    Function that runs the LFP artefact detection of find_LFP_sync_artefact
+    on all LFP channels at once, and selects the channel where the
+    artefacts are best visible (typically the hemisphere where the
+    stimulation was delivered). The dot-products of all channels are
+    computed as in find_LFP_sync_artefact (see _channel_batch_correlation),
+    so the best channel gets the same detections. Each channel is scored
+    with the SNR of its artefacts (median peak height of the detections 
+    divided by the noise level of the channel, from the median absolute
+    deviation) multiplied by the ratio_max_sd of its dot-products. Channels 
+    without detections, or with many detections and a low ratio_max_sd 
+    (no artefacts), get a score of 0.
+
+    Input:
+        - LFP_array (np.ndarray with shape: (x, y)): the intracerebral recording 
+            containing all recorded channels (x channels, y datapoints)
+        - sf_LFP (int): sampling frequency of intracranial recording
+        - use_kernel: kernel used for the dot-products (see LFP_KERNELS)
+        - channels: indexes of the channels to compare, defaults to all
+            (leave out the stimulation amplitude channels)
+        - consider_first_seconds_LFP: if given, only artefacts in the first
+            (and last) n-seconds are considered
+    
+    Returns:
+        - best_channel (int): index of the channel with the highest score
+        - stim_idx: a list with all stim-artefact starts in the best channel
+        - channel_scores: dict with, for each channel index, a dict containing
+            'stim_idx', 'snr', 'ratio_max_sd', 'n_detections' and 'score'
+    """
+
+    # checks correct input for use_kernel variable
+    assert use_kernel in LFP_KERNELS, 'use_kernel incorrect'
+
+    if channels is None:
+        channels = list(range(len(LFP_array)))
+    channels_data = np.asarray(LFP_array)[channels]
+    res_channels = _channel_batch_correlation(channels_data, LFP_KERNELS[use_kernel])
+
+    centered = channels_data - np.median(channels_data, axis=1, keepdims=True)
+    noise_levels = 1.4826 * np.median(np.abs(centered), axis=1)
+
+    channel_scores = {}
+    for ch, lfp_data, res, noise_level in zip(channels, channels_data, res_channels, noise_levels):
+        stim_idx, _, ratio_max_sd = _detect_LFP_artefacts(
+            res, lfp_data, sf_LFP, consider_first_seconds_LFP
+        )
+        if len(stim_idx) > 0 and noise_level > 0:
+            heights = np.max(np.abs(_peak_windows(lfp_data, stim_idx)), axis=1)
+            snr = np.median(heights) / noise_level
+        else:
+            snr = 0
+        no_artefacts = len(stim_idx) > 20 and ratio_max_sd < 8
+        channel_scores[ch] = {
+            'stim_idx': stim_idx,
+            'snr': snr,
+            'ratio_max_sd': ratio_max_sd,
+            'n_detections': len(stim_idx),
+            'score': 0 if no_artefacts else snr * ratio_max_sd
+        }
+
+    best_channel = max(channels, key=lambda ch: channel_scores[ch]['score'])
+    print(f'Best channel for artefact detection: index {best_channel}')
+
+    return best_channel, channel_scores[best_channel]['stim_idx'], channel_scores
+
+
+
+def iter_LFP_sync_artefacts(
+    lfp_chunks,
+    sf_LFP,
+    use_kernel: str = '1',
+    min_ratio_sd: float = 8,
+    n_heights: int = 100,
+):
+    """
+    Generator version of find_LFP_sync_artefact, for recordings which do
+    not fit in memory (or which are still being recorded). The LFP signal 
+    is consumed chunk by chunk, and only the last seconds of signal and 
+    dot-products are kept (plus the first 30 seconds, until the detection
+    thresholds are known), so that memory stays constant whatever the 
+    recording length. The stim-artefact starts are yielded once the 
+    thresholds are known, as soon as the two seconds following them have
+    been received. The peaks are decided second by second, with thresholds
+    which do not change afterwards, so the artefacts found do not depend on
+    the size of the chunks.
+
+    As the whole recording is never available, the detection differs from
+    find_LFP_sync_artefact in the following points:
+        - the peaks of the dot-products must reach 30% of the maximum
+            (minimum for inverted signals) of the dot-products during the 
+            first 30 seconds, instead of the maximum of the whole recording,
+            and at least min_ratio_sd times their std dev during the first
+            5 seconds
+        - the inversion of the signal is decided on the first artefact
+        - the peak height and polarity checks use the median height of the 
+            last n_heights artefacts
+        - consider_first_seconds_LFP is not available, since the end of the
+            recording is unknown
+
+    Input:
+        - lfp_chunks: iterable of np.ndarray, the consecutive chunks of a 
+            single LFP channel (of any length), e.g. 
+            (lfp_data[i: i + n] for i in range(0, len(lfp_data), n))
+        - sf_LFP (int): sampling frequency of intracranial recording
+        - use_kernel: kernel used for the dot-products (see LFP_KERNELS)
+        - min_ratio_sd: minimal ratio between a peak of the dot-products and
+            their std dev during the first 5 seconds
+        - n_heights: number of previous artefacts used for the median height
+    
+    Yields:
+        - index of each stim-artefact start
+    """
+
+    # checks correct input for use_kernel variable
+    assert use_kernel in LFP_KERNELS, 'use_kernel incorrect'
+
+    ker = LFP_KERNELS[use_kernel]
+    distance = int(sf_LFP)
+    n_baseline = int(sf_LFP*5)
+    n_ratio = int(sf_LFP*30)
+
+    # buffers of signal and dot-products, starting at data_start and res_start
+    data_buf, data_start = np.zeros(0), 0
+    res_buf, res_start = np.zeros(0), 0
+    decided_until = 0  # the peaks before this index have been decided
+
+    # statistics of the first seconds, fixed once they are received
+    baseline_sum, baseline_sumsq, baseline_count = 0., 0., 0
+    ratio_max, ratio_min = -np.inf, np.inf
+    pos_height, neg_height = None, None
+    signal_inverted = None
+    heights = deque(maxlen=n_heights)
+    n_found = 0
+
+    def baseline_sd():
+        return np.sqrt(max(
+            baseline_sumsq / baseline_count - (baseline_sum / baseline_count)**2, 0
+        ))
+
+    def decide_peaks(confirm_until):
+        # the peaks in [decided_until, confirm_until) are decided with the
+        # dot-products from decided_until - distance to confirm_until + distance
+        nonlocal signal_inverted, decided_until
+
+        res_dec = res_buf[:confirm_until + distance - res_start]
+        pos_idx = find_peaks(
+            x=res_dec, height=pos_height, distance=distance
+        )[0] + res_start
+        neg_idx = find_peaks(
+            x=-res_dec, height=neg_height, distance=distance
+        )[0] + res_start
+        pos_idx = pos_idx[(pos_idx >= decided_until) & (pos_idx < confirm_until)]
+        neg_idx = neg_idx[(neg_idx >= decided_until) & (neg_idx < confirm_until)]
+
+        # check whether signal is inverted, on the first artefact
+        if signal_inverted is None and (len(pos_idx) or len(neg_idx)):
+            signal_inverted = len(pos_idx) == 0 or (len(neg_idx) and neg_idx[0] < pos_idx[0])
+            if signal_inverted and len(pos_idx) and (pos_idx[0] - neg_idx[0]) < 50:
+                # re-check, undo invertion if negative dot-product is very narrow
+                # (widths are measured over one second at most)
+                width_pos = 0
+                r_i = pos_idx[0] - res_start
+                while width_pos < distance and res_dec[r_i] > (ratio_max * .3):
+                    r_i += 1
+                    width_pos += 1
+                width_neg = 0
+                r_i = neg_idx[0] - res_start
+                while width_neg < distance and res_dec[r_i] < (ratio_min * .3):
+                    r_i += 1
+                    width_neg += 1
+                if width_pos > (2 * width_neg):
+                    signal_inverted = False
+            if signal_inverted:
+                print('signal is inverted')
+
+        decided_until = confirm_until
+
+        # filter out inconsistencies in peak heights and check polarity of peak
+        stim_idx = neg_idx if signal_inverted else pos_idx
+        for i in stim_idx:
+            window = _peak_windows(data_buf, [i - data_start])[0]
+            abs_height = np.max(np.abs(window))
+            heights.append(abs_height)
+            median_height = np.median(heights)
+            if abs(abs_height - median_height) >= median_height * .66:
+                continue
+            if not signal_inverted and np.min(window) < median_height * -.5:
+                yield int(i)
+            elif signal_inverted and np.max(window) > median_height * .5:
+                yield int(i)
+
+    def set_heights():
+        # thresholds of the peaks, fixed for the rest of the recording
+        nonlocal pos_height, neg_height
+        pos_height = max(.3 * ratio_max, min_ratio_sd * baseline_sd())
+        neg_height = max(-.3 * ratio_min, min_ratio_sd * baseline_sd())
+
+    for chunk in lfp_chunks:
+        data_buf = np.concatenate((data_buf, np.asarray(chunk, dtype=float)))
+
+        # dot-products which can be computed with the new samples
+        new_start = res_start + len(res_buf)
+        new_res = _kernel_correlation(data_buf[new_start - data_start:], ker)
+        if len(new_res) == 0:
+            continue
+        res_buf = np.concatenate((res_buf, new_res))
+        baseline_res = new_res[:max(n_baseline - new_start, 0)]
+        baseline_sum += np.sum(baseline_res)
+        baseline_sumsq += np.sum(baseline_res**2)
+        baseline_count += len(baseline_res)
+        if new_start < n_ratio:
+            ratio_max = max(ratio_max, np.max(new_res[:n_ratio - new_start]))
+            ratio_min = min(ratio_min, np.min(new_res[:n_ratio - new_start]))
+
+        if res_start + len(res_buf) < n_ratio:
+            continue
+        if pos_height is None:
+            set_heights()
+
+        # peaks are decided second by second, once the following second
+        # has been received
+        while decided_until + 2 * distance <= res_start + len(res_buf):
+            for i in decide_peaks(decided_until + distance):
+                n_found += 1
+                yield i
+
+            # keep only what is needed to decide the next peaks
+            keep_from = max(decided_until - distance, res_start)
+            res_buf, res_start = res_buf[keep_from - res_start:], keep_from
+            keep_data_from = max(keep_from - 5, data_start)
+            data_buf, data_start = data_buf[keep_data_from - data_start:], keep_data_from
+
+    if baseline_count > 0:
+        if pos_height is None:
+            set_heights()
+        for i in decide_peaks(res_start + len(res_buf)):
+            n_found += 1
+            yield i
+
+        # check warn if NO STIM artefacts are suspected
+        if n_found > 20 and ratio_max / baseline_sd() < 8:
+            print('WARNING: probably the LFP signal did NOT'
+                  ' contain any artefacts. Many incorrect timings'
+                  ' could be returned')
+
+
+
+def refine_onsets(
+    data: np.ndarray,
+    onset_idx,
+    use_kernel: str = None,
+    method: str = 'parabolic',
+    upsampling: int = 16,
+    half_width: int = 8
+):
+    """
+    Function that refines the integer artefact starts found by 
+    find_LFP_sync_artefact or find_external_sync_artefact to fractional 
+    sample indexes, by interpolating only a small window around each of
+    them (the signals are never resampled as a whole).
+    For LFP onsets (use_kernel given), the peak of the kernel dot-products
+    is refined. For external onsets, the local minimum (or maximum if the 
+    signal is reversed) of the filtered signal is refined.
+
+    Inputs:
+        - data: the signal in which the onsets were found, as np.ndarray
+            (LFP channel, or filtered external channel)
+        - onset_idx: list of artefact starts (integer indexes)
+        - use_kernel: the kernel used by find_LFP_sync_artefact (or the
+            template of find_LFP_sync_artefact_template), or None for 
+            external onsets
+        - method: 'parabolic' (vertex of the parabola through the peak and
+            its two neighbours) or 'upsample' (polyphase interpolation of
+            the window by the factor upsampling, then parabolic fit)
+        - upsampling (int): upsampling factor of the 'upsample' method
+        - half_width (int): half length of the interpolated windows in samples
+
+    Returns:
+        - refined_idx: np.ndarray of fractional artefact starts, which can
+            be converted to times with utils.convert_index_to_time
+    """
+
+    assert method in ('parabolic', 'upsample'), 'method incorrect'
+    onset_idx = np.asarray(onset_idx, dtype=int)
+    if len(onset_idx) == 0:
+        return onset_idx.astype(float)
+
+    if use_kernel is None:
+        windows = _peak_windows(data, onset_idx, half_width)
+    else:
+        # kernel dot-products around each onset (a template is centered on
+        # the onset, see find_LFP_sync_artefact_template)
+        if isinstance(use_kernel, str):
+            ker, kernel_offset = LFP_KERNELS[use_kernel], 0
+        else:
+            ker = np.asarray(use_kernel)
+            kernel_offset = len(ker) // 2
+        window_idx = onset_idx[:, None] - kernel_offset + np.arange(
+            -half_width, half_width + len(ker) - 1
+        )
+        data_windows = data[np.clip(window_idx, 0, len(data) - 1)]
+        windows = np.lib.stride_tricks.sliding_window_view(
+            data_windows, len(ker), axis=1
+        ) @ ker
+    windows = windows.astype(float)
+
+    # orient each window so that the onset is a maximum
+    windows *= np.where(
+        windows[:, half_width] >= np.median(windows, axis=1), 1, -1
+    )[:, None]
+
+    if method == 'parabolic':
+        shift = _parabolic_peak_shift(windows, np.full(len(windows), half_width))
+    elif method == 'upsample':
+        upsampled = resample_poly(windows, upsampling, 1, axis=1)
+        search = np.arange((half_width - 1) * upsampling, (half_width + 1) * upsampling + 1)
+        i_peak = search[np.argmax(upsampled[:, search], axis=1)]
+        shift = (i_peak + _parabolic_peak_shift(upsampled, i_peak)) / upsampling - half_width
+
+    return onset_idx + shift
+
+
+
+def _parabolic_peak_shift(
+    windows: np.ndarray,
+    i_peak: np.ndarray
+):
+    """
+    Function that returns, for each row of windows, the position of the 
+    vertex of the parabola through windows[i_peak - 1: i_peak + 2],
+    relative to i_peak (between -0.5 and 0.5, 0 if the peak is flat).
+    """
+
+    rows = np.arange(len(windows))
+    left = windows[rows, i_peak - 1]
+    center = windows[rows, i_peak]
+    right = windows[rows, i_peak + 1]
+    curvature = left - 2 * center + right
+    shift = np.zeros(len(windows))
+    fit = curvature < 0
+    shift[fit] = .5 * (left[fit] - right[fit]) / curvature[fit]
+
+    return np.clip(shift, -.5, .5)
+
+
+
+def _detect_LFP_artefacts(
+    res: np.ndarray,
+    lfp_data: np.ndarray,
+    sf_LFP,
+    consider_first_seconds_LFP=None,
+    search_mask: np.ndarray = None,
+):
+    """
+    Function that picks the stim-artefact starts from the dot-products
+    between a kernel and the LFP signal (see find_LFP_sync_artefact).
+
+    Inputs:
+        - res: kernel dot-products as np.ndarray
+        - lfp_data: single channel as np.ndarray
+        - sf_LFP (int): sampling frequency of intracranial recording
+        - consider_first_seconds_LFP: if given, only artefacts in the first
+            (and last) n-seconds are considered
+        - search_mask: if the dot-products were only computed in search 
+            windows, boolean mask (same length as res) of these windows. 
+            ratio_max_sd is then computed over the first seconds inside 
+            the windows
+
+    Returns:
+        - stim_idx: a list with all stim-artefact starts
+        - signal_inverted: True if the LFP signal was found to be inverted
+        - ratio_max_sd: ratio between maximum and std dev of the normalised
+            dot-products in the first seconds (high if artefacts are present)
+    """
+
+    signal_inverted = False  # defaults false
 
     # # normalise dot product results
-    res = res / max(res)
+    res = res / np.max(res)
 
     # calculate a ratio between std dev and maximum during
     # the first seconds to check whether an stim-artef was present 
-    ratio_max_sd = np.max(res[:sf_LFP*30] / np.std(res[:sf_LFP*5]))
+    first_res = res if search_mask is None else res[search_mask]
+    baseline_sd = np.std(first_res[:sf_LFP*5])
+    if baseline_sd > 0:
+        ratio_max_sd = np.max(first_res[:sf_LFP*30] / baseline_sd)
+    else:
+        # flat signal
+        ratio_max_sd = np.inf
     
     # use peak of kernel dot products    
     pos_idx = find_peaks(
         x=res, 
-        height=.3 * max(res),
+        height=.3 * np.max(res),
         distance=sf_LFP
     )[0]
     neg_idx = find_peaks(
         x=-res, 
-        height=-.3 * min(res),
+        height=-.3 * np.min(res),
         distance=sf_LFP
     )[0]
 
     # check whether signal is inverted
-    if neg_idx[0] < pos_idx[0]:
+    if len(neg_idx) and len(pos_idx) and neg_idx[0] < pos_idx[0]:
         # the first peak should be POSITIVE (this is for the dot-product results)
         # actual signal is first peak negative
         # if NEG peak before POS then signal is inverted
@@ -216,14 +1307,15 @@ def find_LFP_sync_artefact(
         #print(pos_idx[0], neg_idx[0])
         # re-check inverted for difficult cases with small pos-lfp peak before negative stim-artefact
         if (pos_idx[0] - neg_idx[0]) < 50:  # if first positive and negative are very close
+            res_max, res_min = np.max(res), np.min(res)
             width_pos = 0
             r_i = pos_idx[0]
-            while res[r_i] > (max(res) * .3):
+            while res[r_i] > (res_max * .3):
                 r_i += 1
                 width_pos += 1
             width_neg = 0
             r_i = neg_idx[0]
-            while res[r_i] < (min(res) * .3):
+            while res[r_i] < (res_min * .3):
                 r_i += 1
                 width_neg += 1
             # undo invertion if negative dot-product (pos lfp peak) is very narrow
@@ -257,16 +1349,352 @@ def find_LFP_sync_artefact(
 
 
     # filter out inconsistencies in peak heights (assuming sync-stim-artefacts are stable)
-    abs_heights = [max(abs(lfp_data[i - 5: i + 5])) for i in stim_idx]
-    diff_median = np.array([abs(p - np.median(abs_heights)) for p in abs_heights])
-    sel_idx = diff_median < (np.median(abs_heights)*.66)
-    stim_idx = list(compress(stim_idx, sel_idx))
+    stim_idx = np.array(stim_idx, dtype=int)
+    if len(stim_idx) == 0:
+        return [], signal_inverted, ratio_max_sd
+    windows = _peak_windows(lfp_data, stim_idx)
+    abs_heights = np.max(np.abs(windows), axis=1)
+    median_height = np.median(abs_heights)
+    sel_idx = np.abs(abs_heights - median_height) < (median_height * .66)
     # check polarity of peak
     if not signal_inverted:
-        sel_idx = np.array([min(lfp_data[i - 5: i + 5]) for i in stim_idx]) < (np.median(abs_heights) * -.5)
+        sel_idx &= np.min(windows, axis=1) < (median_height * -.5)
     elif signal_inverted:
-        sel_idx = np.array([max(lfp_data[i - 5: i + 5]) for i in stim_idx])  > (np.median(abs_heights) * .5)
-    stim_idx = list(compress(stim_idx, sel_idx))
+        sel_idx &= np.max(windows, axis=1) > (median_height * .5)
+    stim_idx = stim_idx[sel_idx].tolist()
 
 
-    return stim_idx
+    return stim_idx, signal_inverted, ratio_max_sd
+
+
+
+def _peak_windows(
+    data: np.ndarray,
+    peak_idx: np.ndarray,
+    half_width: int = 5
+):
+    """
+    Function that returns the windows data[i - half_width: i + half_width]
+    around each peak index i, as an array of shape (len(peak_idx), 2 * half_width).
+    Windows crossing the borders of the signal are clipped to it (the first
+    or last sample is repeated, which does not change their min or max).
+    """
+
+    window_idx = np.asarray(peak_idx)[:, None] + np.arange(-half_width, half_width)
+
+    return data[np.clip(window_idx, 0, len(data) - 1)]
+
+
+
+def _kernel_correlation(
+    data: np.ndarray,
+    ker: np.ndarray
+):
+    """
+    Function that computes the dot-product between the kernel and every
+    snippet of the signal of the same length, i.e.
+    res[i] = ker @ data[i: i + len(ker)] for i in range(len(data) - len(ker)).
+    Short kernels are correlated directly (np.correlate), long kernels by
+    FFT overlap-add.
+
+    Inputs:
+        - data: single channel as np.ndarray
+        - ker: the kernel as np.ndarray
+
+    Returns:
+        - res: np.ndarray of length len(data) - len(ker)
+    """
+
+    n_res = max(len(data) - len(ker), 0)
+    if len(ker) <= DIRECT_CORRELATION_MAX_KERNEL:
+        res = np.correlate(data, ker, mode='valid')
+    else:
+        res = oaconvolve(data, ker[::-1], mode='valid')
+
+    return res[:n_res]
+
+
+
+def find_stim_change_windows(
+    stim_amplitude: np.ndarray,
+    sf_stim,
+    margin_seconds: float = 2,
+    min_change: float = 0
+):
+    """
+    Function that finds the time windows where the stimulation amplitude
+    changes, from the low-rate stimulation amplitude channels of the 
+    Percept recordings (e.g. LFP_array[4:6] as in plotting.plot_LFP_stim, 
+    or the 'stim_amplitude' of loading._load_percept_json_streams).
+    These windows can be given as search_windows to find_LFP_sync_artefact,
+    so that the artefacts are only searched around the stimulation changes.
+
+    Inputs:
+        - stim_amplitude: np.ndarray, one (1d) or several (2d, one channel
+            per row) stimulation amplitude channels in mA
+        - sf_stim (int): sampling frequency of the stimulation channels
+        - margin_seconds: margin added before and after each change (the
+            stimulation channels are less precise than the LFP channels)
+        - min_change: minimal amplitude change in mA
+    
+    Returns:
+        - windows: list of (start, stop) tuples in seconds, sorted and
+            non-overlapping
+    """
+
+    stim_amplitude = np.atleast_2d(stim_amplitude)
+    # a change between samples k and k + 1
+    changes = np.flatnonzero(
+        np.any(np.abs(np.diff(stim_amplitude, axis=-1)) > min_change, axis=0)
+    )
+    if len(changes) == 0:
+        return []
+
+    starts = np.maximum(changes / sf_stim - margin_seconds, 0)
+    stops = np.minimum((changes + 1) / sf_stim + margin_seconds, stim_amplitude.shape[-1] / sf_stim)
+    # merge overlapping windows
+    new_window = np.concatenate(([True], starts[1:] > stops[:-1]))
+    first_of_window = np.flatnonzero(new_window)
+    last_of_window = np.concatenate((first_of_window[1:] - 1, [len(changes) - 1]))
+
+    return [
+        (float(starts[first]), float(stops[last]))
+        for first, last in zip(first_of_window, last_of_window)
+    ]
+
+
+
+def _windows_to_index(
+    windows: list,
+    sf
+):
+    """
+    Function that converts a list of (start, stop) windows in seconds to
+    a list of (start, stop) windows in samples.
+    """
+
+    return [(int(start * sf), int(np.ceil(stop * sf))) for start, stop in windows]
+
+
+
+def _windows_to_mask(
+    windows: list,
+    n_samples: int
+):
+    """
+    Function that converts a list of (start, stop) windows in samples to
+    a boolean mask of length n_samples, True inside the windows.
+    """
+
+    mask = np.zeros(n_samples, dtype=bool)
+    for start, stop in windows:
+        mask[max(start, 0):max(stop, 0)] = True
+
+    return mask
+
+
+
+def _windowed_kernel_correlation(
+    data: np.ndarray,
+    ker: np.ndarray,
+    windows: list
+):
+    """
+    Function that computes the dot-products of _kernel_correlation only 
+    inside the given windows (list of (start, stop) indexes), and sets
+    them to 0 elsewhere.
+    """
+
+    n_res = max(len(data) - len(ker), 0)
+    res = np.zeros(n_res)
+    for start, stop in windows:
+        start, stop = max(start, 0), min(stop, n_res)
+        if stop > start:
+            res[start:stop] = _kernel_correlation(data[start: stop + len(ker)], ker)
+
+    return res
+
+
+
+def _coarse_to_fine_kernel_correlation(
+    data: np.ndarray,
+    ker: np.ndarray,
+    block_size: int,
+    exact_samples: int = 0,
+    n_top_blocks: int = 16
+):
+    """
+    Function that computes the dot-products of _kernel_correlation only 
+    where they can reach the detection height of _detect_LFP_artefacts 
+    (30% of the maximum, or of the minimum for inverted signals), 
+    and sets them to 0 elsewhere.
+    Coarse pass: the dot-products of a block are bounded by 
+    sum(abs(ker)) * max(abs(data)) over the samples the block depends on.
+    Fine pass: the dot-products are computed exactly in the blocks with the
+    highest bounds first, which gives the maximum and minimum, then in all 
+    blocks whose bound reaches 30% of them, and in their neighbouring 
+    blocks (so that the borders of every peak are exact). 
+    The peaks found in the result are the same as with _kernel_correlation.
+
+    Inputs:
+        - data: single channel as np.ndarray
+        - ker: the kernel as np.ndarray
+        - block_size: number of dot-products per block
+        - exact_samples: the first exact_samples dot-products are always
+            computed (used for the ratio_max_sd check)
+        - n_top_blocks: number of blocks with the highest bound computed first
+
+    Returns:
+        - res: np.ndarray of length len(data) - len(ker)
+    """
+
+    n_res = max(len(data) - len(ker), 0)
+    res = np.zeros(n_res)
+    n_blocks = int(np.ceil(n_res / block_size))
+    if n_blocks == 0:
+        return res
+
+    # coarse pass: envelope of the signal per block, and bound of the
+    # dot-products of each block (which also depend on the len(ker) - 1
+    # samples after the block)
+    block_max = _block_reduce(np.abs(data), block_size, np.max)
+    n_next_blocks = int(np.ceil((len(ker) - 1) / block_size))
+    block_max = np.concatenate((block_max, np.zeros(n_blocks + n_next_blocks)))
+    bound = block_max[:n_blocks].copy()
+    for shift in range(1, n_next_blocks + 1):
+        bound = np.maximum(bound, block_max[shift: shift + n_blocks])
+    bound *= np.sum(np.abs(ker)) * (1 + 1e-6)  # margin for rounding errors
+
+    computed = np.zeros(n_blocks, dtype=bool)
+
+    def compute_blocks(selected):
+        for first_block, last_block in _consecutive_runs(np.flatnonzero(selected & ~computed)):
+            start = first_block * block_size
+            stop = min((last_block + 1) * block_size, n_res)
+            res[start:stop] = _kernel_correlation(data[start: stop + len(ker)], ker)
+        computed[selected] = True
+
+    # fine pass
+    selected = np.zeros(n_blocks, dtype=bool)
+    selected[:int(np.ceil(exact_samples / block_size))] = True
+    selected[np.argsort(bound)[-n_top_blocks:]] = True
+    compute_blocks(selected)
+    while True:
+        min_height = .3 * min(np.max(res), -np.min(res))
+        selected = ~computed & (bound >= min_height)
+        if not np.any(selected):
+            break
+        compute_blocks(selected)
+    neighbours = np.zeros(n_blocks, dtype=bool)
+    neighbours[1:] |= computed[:-1]
+    neighbours[:-1] |= computed[1:]
+    compute_blocks(neighbours)
+
+    return res
+
+
+
+def _channel_batch_correlation(
+    data: np.ndarray,
+    ker: np.ndarray
+):
+    """
+    Function that computes _kernel_correlation for all rows (channels) of
+    a 2d array. Short kernels (up to DIRECT_CORRELATION_MAX_KERNEL samples)
+    are correlated directly, channel by channel, exactly as in 
+    find_LFP_sync_artefact. Long kernels are correlated with all channels 
+    at once, by batched FFT along the time axis.
+
+    Inputs:
+        - data: np.ndarray with shape (channels, samples)
+        - ker: the kernel as np.ndarray
+
+    Returns:
+        - res: np.ndarray with shape (channels, samples - len(ker))
+    """
+
+    if len(ker) <= DIRECT_CORRELATION_MAX_KERNEL:
+        return np.array([_kernel_correlation(lfp_data, ker) for lfp_data in data])
+
+    n_samples = data.shape[-1]
+    n_fft = fft.next_fast_len(n_samples + len(ker) - 1, real=True)
+    correlations = fft.irfft(
+        fft.rfft(data, n_fft, axis=-1) * np.conj(fft.rfft(np.asarray(ker, dtype=float), n_fft)),
+        n_fft, axis=-1
+    )
+
+    return correlations[:, :max(n_samples - len(ker), 0)]
+
+
+
+def _kernel_bank_correlation(
+    data: np.ndarray,
+    kernels: list
+):
+    """
+    Function that computes _kernel_correlation for several kernels at once.
+    Short kernels (up to DIRECT_CORRELATION_MAX_KERNEL samples) are 
+    correlated directly, exactly as in find_LFP_sync_artefact, so that the
+    peaks (and their ties on quantized signals) are the same. Long kernels
+    are correlated together in a single batched FFT (see 
+    _fft_kernel_correlation).
+
+    Inputs:
+        - data: single channel as np.ndarray
+        - kernels: list of kernels as np.ndarray (can have different lengths)
+
+    Returns:
+        - res_bank: list of np.ndarray, res_bank[k] has length 
+            len(data) - len(kernels[k])
+    """
+
+    res_bank = [None] * len(kernels)
+    long_kernels = []
+    for i_ker, ker in enumerate(kernels):
+        if len(ker) <= DIRECT_CORRELATION_MAX_KERNEL:
+            res_bank[i_ker] = _kernel_correlation(data, ker)
+        else:
+            long_kernels.append(i_ker)
+
+    if long_kernels:
+        long_res = _fft_kernel_correlation(data, [kernels[i] for i in long_kernels])
+        for i_ker, res in zip(long_kernels, long_res):
+            res_bank[i_ker] = res
+
+    return res_bank
+
+
+
+def _fft_kernel_correlation(
+    data: np.ndarray,
+    kernels: list
+):
+    """
+    Function that computes _kernel_correlation for several kernels by FFT:
+    the signal is transformed once and multiplied with the spectra of all
+    kernels in a single batched operation.
+
+    Inputs:
+        - data: single channel as np.ndarray
+        - kernels: list of kernels as np.ndarray (can have different lengths)
+
+    Returns:
+        - res_bank: list of np.ndarray, res_bank[k] has length 
+            len(data) - len(kernels[k])
+    """
+
+    max_len = max(len(ker) for ker in kernels)
+    n_fft = fft.next_fast_len(len(data) + max_len - 1, real=True)
+
+    padded_kernels = np.zeros((len(kernels), max_len))
+    for i_ker, ker in enumerate(kernels):
+        padded_kernels[i_ker, :len(ker)] = ker
+
+    data_spectrum = fft.rfft(data, n_fft)
+    kernel_spectra = fft.rfft(padded_kernels, n_fft, axis=1)
+    correlations = fft.irfft(data_spectrum * np.conj(kernel_spectra), n_fft, axis=1)
+
+    return [
+        correlations[i_ker, :max(len(data) - len(ker), 0)] 
+        for i_ker, ker in enumerate(kernels)
+    ]
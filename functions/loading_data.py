@@ -1,11 +1,19 @@
 import numpy as np
+import pandas as pd
 import os
 import json
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import functions.tmsi_poly5reader as poly5_reader
+import functions.find_packet_loss as pkl
+import functions.find_artefacts as artefact
+import functions.preprocessing as preproc
 
 # Function to open TMSi data
 
 def _load_TMSi_artefact_channel(
-    TMSi_data
+    TMSi_data,
+    toMNE = True
 ):
     
 	"""
@@ -16,6 +24,14 @@ def _load_TMSi_artefact_channel(
 	
 	Input:
 		- TMSi_data : TMSiFileFormats.file_readers.poly5reader.Poly5Reader
+			(if it was opened with channels=[...], only these channels are
+			returned, the other ones can be read later with 
+			TMSi_data.readChannels()), or the path to a .Poly5 file, which is 
+			then opened using the decoded-data cache folder given as 
+			'cache_dir' in the config file
+		- toMNE (bool): default True, the recording is converted to an MNE 
+			RawArray. If False, the samples are converted to volts directly as
+			a numpy array and MNE is not used.
 
 	Returns:
 		- TMSi_channel (np.ndarray with shape (y,)): the channel of the external 
@@ -27,6 +43,8 @@ def _load_TMSi_artefact_channel(
 		- external_rec_ch_names (list of x names): the names of all the channels 
             recorded externally
 		- sf_external (int): sampling frequency of external recording
+		- BIP_ch_index (int): index of the channel used for alignment in 
+			TMSi_file (TMSi_channel is a view on this row)
 	"""
 
 	# import SETTINGS
@@ -35,39 +53,159 @@ def _load_TMSi_artefact_channel(
 	with open(os.path.join(json_path, json_filename), 'r') as f:
 		loaded_dict =  json.load(f)
 
-	# Conversion of .Poly5 to MNE raw array
-	toMNE = True
-	TMSi_rec = TMSi_data.read_data_MNE()
-	external_rec_ch_names = TMSi_rec.ch_names
-	n_chan = len(TMSi_rec.ch_names)
-	time_duration_TMSi_s = (TMSi_rec.n_times/TMSi_rec.info['sfreq']).astype(float)
-	sf_external = int(TMSi_rec.info['sfreq'])
+	if isinstance(TMSi_data, str):
+		TMSi_data = poly5_reader.Poly5Reader(
+			TMSi_data, 
+			cache_dir=loaded_dict.get('cache_dir')
+		)
 
-	if _is_channel_in_list(external_rec_ch_names, loaded_dict['ch_name_BIP']):
-		ch_t = TMSi_rec.ch_names.index(loaded_dict['ch_name_BIP'])
-		TMSi_channel = TMSi_rec.get_data()[ch_t]
-		loaded_dict['BIP_ch_index'] = ch_t
+	# Conversion of .Poly5 to MNE raw array, or directly to a numpy array
+	if toMNE:
+		TMSi_rec = TMSi_data.read_data_MNE()
+		TMSi_array = TMSi_rec.get_data()
+		external_rec_ch_names = TMSi_rec.ch_names
+		sf_external = int(TMSi_rec.info['sfreq'])
+	else:
+		TMSi_array, external_rec_ch_names, sf_external = TMSi_data.read_data_array()
+		sf_external = int(sf_external)
+	n_times = TMSi_array.shape[1]
+	n_chan = len(external_rec_ch_names)
+	time_duration_TMSi_s = float(n_times/sf_external)
+
+	if not _is_channel_in_list(external_rec_ch_names, loaded_dict['ch_name_BIP']):
+		# find the channel carrying the stimulation artefacts
+		if loaded_dict['ch_name_BIP'] != 'auto':
+			print(f'The channel {loaded_dict["ch_name_BIP"]} does not exist in the list, '
+				  f'searching the channel with the stimulation artefacts.')
+		ch_t = _find_TMSi_artefact_channel(TMSi_array, external_rec_ch_names, sf_external)
+		if ch_t is not None:
+			loaded_dict['ch_name_BIP'] = external_rec_ch_names[ch_t]
 
-		# save dict as JSON, 'w' stands for write
-		with open(os.path.join(json_path, json_filename), 'w') as f:
-				json.dump(loaded_dict, f, indent=4)
+	if _is_channel_in_list(external_rec_ch_names, loaded_dict['ch_name_BIP']):
+		ch_t = external_rec_ch_names.index(loaded_dict['ch_name_BIP'])
+		TMSi_channel = TMSi_array[ch_t]  # view, the data is not copied
+		BIP_ch_index = ch_t
 		
 		print(     
-			f'The data object has:\n\t{TMSi_rec.n_times} time samples,'      
-			f'\n\tand a sample frequency of {TMSi_rec.info["sfreq"]} Hz'      
+			f'The data object has:\n\t{n_times} time samples,'      
+			f'\n\tand a sample frequency of {sf_external} Hz'      
 			f'\n\twith a recording duration of {time_duration_TMSi_s} seconds.'      
-			f'\n\t{n_chan} channels were labeled as \n{TMSi_rec.ch_names}.')
+			f'\n\t{n_chan} channels were labeled as \n{external_rec_ch_names}.')
 		
-		print(f'The channel used to align datas is the channel named {TMSi_rec.ch_names[ch_t]} and has index {ch_t}')
+		print(f'The channel used to align datas is the channel named {external_rec_ch_names[ch_t]} and has index {ch_t}')
 
-		TMSi_file = TMSi_rec.get_data()
+		TMSi_file = TMSi_array
 
 	else:
 		raise ValueError(f'The channel does not exist in the list. '
 				   		f'\n\tPlease choose a channel in the following list and write its name in the config file  {external_rec_ch_names}')
 
 
-	return TMSi_channel, TMSi_file, external_rec_ch_names, sf_external
+	return TMSi_channel, TMSi_file, external_rec_ch_names, sf_external, BIP_ch_index
+
+
+def _load_TMSi_artefact_head_tail(
+    TMSi_data,
+    consider_first_seconds_external,
+    padding_seconds = 1
+):
+    
+	"""
+	Function that reads from disk only the head and tail segments of the
+	channel used for sync which are needed to find the artefacts in the
+	first and last n-seconds of the recording (StimOn sessions), and 
+	filters them (see preprocessing.filtering_segment). The cost does not
+	depend on the duration of the recording.
+	The segments are given to artefact.find_external_sync_artefact_head_tail.
+	
+	Input:
+		- TMSi_data : TMSiFileFormats.file_readers.poly5reader.Poly5Reader
+			(can be opened with readAll=False), or the path to a .Poly5 file
+		- consider_first_seconds_external : the n-seconds at the beginning
+			and at the end of the recording in which artefacts are considered
+		- padding_seconds : extra signal read around the segments to avoid
+			the edge effects of the filter
+
+	Returns:
+		- head (np.ndarray): filtered channel from 0 to head_stop, in volts
+		- tail (np.ndarray): filtered channel from tail_start to the end, in volts
+		- n_samples (int): length of the whole recording
+		- sf_external (int): sampling frequency of external recording
+		- BIP_ch_index (int): index of the channel used for alignment
+	"""
+
+	# import SETTINGS
+	json_path = os.path.join(os.getcwd(), 'config')
+	json_filename = 'config.json'  # dont forget json extension
+	with open(os.path.join(json_path, json_filename), 'r') as f:
+		loaded_dict =  json.load(f)
+
+	if isinstance(TMSi_data, str):
+		TMSi_data = poly5_reader.Poly5Reader(TMSi_data, readAll=False)
+
+	metadata = TMSi_data.metadata()
+	external_rec_ch_names = metadata['ch_names']
+	if not _is_channel_in_list(external_rec_ch_names, loaded_dict['ch_name_BIP']):
+		raise ValueError(f'The channel does not exist in the list. '
+				   		f'\n\tPlease choose a channel in the following list and write its name in the config file  {external_rec_ch_names}')
+	BIP_ch_index = external_rec_ch_names.index(loaded_dict['ch_name_BIP'])
+	sf_external = int(metadata['sample_rate'])
+	n_samples = metadata['num_samples']
+	# convert from microvolts to volts if necessary
+	scale = 1e-6 if metadata['ch_unit_names'][BIP_ch_index] == "µVolt" else 1
+
+	head_stop, tail_start = artefact.external_head_tail_bounds(
+		n_samples, sf_external, consider_first_seconds_external
+	)
+	padding = int(padding_seconds * sf_external)
+
+	head_pad = min(padding, n_samples - head_stop)
+	head = TMSi_data.readChannel(BIP_ch_index, 0, head_stop + head_pad).astype(np.float64)
+	head = preproc.filtering_segment(head * scale, pad_after=head_pad)
+
+	tail_pad = min(padding, tail_start)
+	tail = TMSi_data.readChannel(BIP_ch_index, tail_start - tail_pad, n_samples).astype(np.float64)
+	tail = preproc.filtering_segment(tail * scale, pad_before=tail_pad)
+
+	print(f'Read {len(head) + len(tail)} of {n_samples} samples of the channel '
+	   	  f'{external_rec_ch_names[BIP_ch_index]} (index {BIP_ch_index})')
+
+	return head, tail, n_samples, sf_external, BIP_ch_index
+
+
+def _find_TMSi_artefact_channel(
+	TMSi_array,
+	external_rec_ch_names,
+	sf_external,
+	n_workers = None
+):
+	"""
+	Function that finds the external channel carrying the stimulation
+	artefacts, when its name is unknown (ch_name_BIP "auto" in the config
+	file, or a name which is not in the recording). All channels are
+	high-pass filtered in one call, then ranked in parallel with 
+	artefact.rank_external_channels. The ranking is printed.
+
+	Returns:
+		- ch_t (int): index of the best channel, or None if no channel
+			carries stimulation artefacts
+	"""
+
+	ranking = artefact.rank_external_channels(
+		preproc.filtering(TMSi_array), 
+		sf_external, 
+		ch_names=external_rec_ch_names,
+		n_workers=n_workers
+	)
+	for channel_score in ranking[:5]:
+		print(f'{channel_score["name"]} (index {channel_score["index"]}): '
+			  f'score {channel_score["score"]:.1f}, {channel_score["n_onsets"]} stim onsets, '
+			  f'SNR {channel_score["snr"]:.1f}, threshold {channel_score["thresh_external"]:.3g}')
+
+	if len(ranking) == 0 or ranking[0]['score'] <= 0:
+		return None
+
+	return ranking[0]['index']
 
 
 # extract variables from LFP recording:
@@ -75,10 +213,18 @@ def _set_lfp_data(
         LFP_rec, 
         ch_i = 0
 ):
+    """
+    Function that extracts the LFP recording, the channel containing the
+    artefacts (ch_i, or 'auto' to select the channel where the artefacts 
+    are best detected, see _select_lfp_channel), the channel names and the
+    sampling frequency from an MNE object.
+    """
     LFP_array = LFP_rec.get_data()
-    lfp_sig = LFP_rec.get_data()[ch_i]
     LFP_rec_ch_names = LFP_rec.ch_names
     sf_LFP = int(LFP_rec.info["sfreq"])
+    if ch_i == 'auto':
+        ch_i = _select_lfp_channel(LFP_array, LFP_rec_ch_names, sf_LFP)
+    lfp_sig = LFP_array[ch_i]  # view, the data is not copied
 
     n_chan = len(LFP_rec.ch_names)
     time_duration_LFP = (LFP_rec.n_times/LFP_rec.info['sfreq']).astype(float)
@@ -95,6 +241,175 @@ def _set_lfp_data(
     return LFP_array, lfp_sig, LFP_rec_ch_names, sf_LFP
 
 
+def _load_percept_json_streams(
+        json_object,
+        mode = 'streaming'
+):
+    """
+    Function that reads the time-domain recordings of a Percept JSON report
+    directly into numpy arrays, without PyPerceive nor MNE objects. The 
+    entries of the report belonging to the same recording (one entry per 
+    channel, with the same FirstPacketDateTime) are grouped together.
+
+    Input:
+        - json_object: the loaded JSON report (dict, e.g. from 
+            find_packet_loss.load_sourceJSON) or the path to the .json file
+        - mode (str): 'streaming' (BrainSenseTimeDomain) or 'indef_streaming'
+            (IndefiniteStreaming)
+
+    Returns:
+        - recordings (list of dicts), in the order of the report, with:
+            - 'data' (np.ndarray, float32, with shape: (x, y)): x channels, 
+                y datapoints
+            - 'ch_names' (list of x names)
+            - 'sf' (int): sampling frequency
+            - 'first_packet_time' (str): FirstPacketDateTime of the recording
+            - 'ticks_ms' (np.ndarray): timestamps of the data packets (ms)
+            - 'packet_sizes' (np.ndarray): number of samples in each packet
+            - for BrainSense streamings, if present in the report:
+                'stim_amplitude' (np.ndarray with shape (2, z): left and right 
+                stimulation amplitude in mA), 'stim_ch_names' and 'sf_stim'
+    """
+
+    prc_data_codes = {
+        'streaming': 'BrainSenseTimeDomain',
+        'indef_streaming': 'IndefiniteStreaming'
+    }
+
+    if isinstance(json_object, str):
+        with open(json_object, 'r') as f:
+            json_object = json.loads(f.read())
+
+    entries = json_object.get(prc_data_codes[mode], [])
+
+    # group the entries (one per channel) by recording
+    grouped = {}
+    for dat in entries:
+        grouped.setdefault(dat['FirstPacketDateTime'], []).append(dat)
+
+    stim_entries = {}
+    if mode == 'streaming':
+        for dat in json_object.get('BrainSenseLfp', []):
+            stim_entries[dat['FirstPacketDateTime']] = dat
+
+    recordings = []
+    for first_packet_time, channels in grouped.items():
+        signals = [np.asarray(dat['TimeDomainData'], dtype=np.float32) for dat in channels]
+        n_samples = min(len(sig) for sig in signals)
+        if any(len(sig) != n_samples for sig in signals):
+            print(f'WARNING: channels of the recording starting at {first_packet_time} '
+                  f'have different lengths, they are cut to {n_samples} samples')
+
+        rec = {
+            'data': np.stack([sig[:n_samples] for sig in signals]),
+            'ch_names': [dat['Channel'] for dat in channels],
+            'sf': int(channels[0]['SampleRateInHz']),
+            'first_packet_time': first_packet_time,
+            'ticks_ms': np.array(pkl.convert_list_string_floats(channels[0]['TicksInMses'])),
+            'packet_sizes': np.array(pkl.convert_list_string_floats(channels[0]['GlobalPacketSizes'])),
+        }
+
+        if first_packet_time in stim_entries:
+            stim_dat = stim_entries[first_packet_time]
+            rec['stim_amplitude'] = np.array(
+                [[sample[side]['mA'] for sample in stim_dat['LfpData']] 
+                 for side in ['Left', 'Right']],
+                dtype=np.float32
+            )
+            rec['stim_ch_names'] = ['STIM_L', 'STIM_R']
+            rec['sf_stim'] = int(stim_dat['SampleRateInHz'])
+
+        recordings.append(rec)
+
+    return recordings
+
+
+def _set_lfp_data_from_json(
+        json_object,
+        i_rec = 0,
+        ch_i = 0,
+        mode = 'streaming'
+):
+    """
+    Same as _set_lfp_data, but the LFP recording is read directly from 
+    a Percept JSON report (see _load_percept_json_streams).
+
+    Input:
+        - json_object: the loaded JSON report or the path to the .json file
+        - i_rec (int): index of the recording in the report
+        - ch_i (int): index of the channel containing the artefacts, or 
+            'auto' (see _select_lfp_channel)
+        - mode (str): 'streaming' or 'indef_streaming'
+    
+    Returns:
+        - LFP_array (np.ndarray with shape: (x, y)), lfp_sig (np.ndarray with 
+            shape (y,)), LFP_rec_ch_names (list of x names), sf_LFP (int)
+    """
+
+    rec = _load_percept_json_streams(json_object, mode=mode)[i_rec]
+    LFP_array = rec['data']
+    LFP_rec_ch_names = rec['ch_names']
+    sf_LFP = rec['sf']
+    if ch_i == 'auto':
+        ch_i = _select_lfp_channel(LFP_array, LFP_rec_ch_names, sf_LFP)
+    lfp_sig = LFP_array[ch_i]
+
+    print(     
+        f'The data object has:\n\t{LFP_array.shape[1]} time samples,'      
+        f'\n\tand a sample frequency of {sf_LFP} Hz'      
+        f'\n\twith a recording duration of {LFP_array.shape[1]/sf_LFP} seconds.'      
+        f'\n\t{len(LFP_rec_ch_names)} channels were labeled as \n{LFP_rec_ch_names}.'
+    )
+    print(
+        f'The channel containing artefacts has index {ch_i} and is named {LFP_rec_ch_names[ch_i]}'
+    )
+
+    return LFP_array, lfp_sig, LFP_rec_ch_names, sf_LFP
+
+
+def _select_lfp_channel(
+        LFP_array,
+        LFP_rec_ch_names,
+        sf_LFP
+):
+    """
+    Function that selects the LFP channel where the stimulation artefacts
+    are best detected, by running the artefact detection on all channels
+    at once (see artefact.find_LFP_sync_artefact_best_channel) with the
+    kernel of the config file. The stimulation amplitude channels (named 
+    STIM) are left out.
+
+    Returns:
+        - ch_i (int): index of the selected channel in LFP_array
+    """
+
+    # import SETTINGS
+    json_path = os.path.join(os.getcwd(), 'config')
+    json_filename = 'config.json'  # dont forget json extension
+    with open(os.path.join(json_path, json_filename), 'r') as f:
+        loaded_dict =  json.load(f)
+
+    kernel = loaded_dict['kernel'] if loaded_dict['kernel'] in artefact.LFP_KERNELS else '2'
+    channels = [
+        i for i, ch_name in enumerate(LFP_rec_ch_names) if 'STIM' not in str(ch_name).upper()
+    ]
+    ch_i, _, channel_scores = artefact.find_LFP_sync_artefact_best_channel(
+        LFP_array, 
+        sf_LFP, 
+        use_kernel=kernel, 
+        channels=channels,
+        consider_first_seconds_LFP=loaded_dict['consider_first_seconds_LFP']
+    )
+    for ch in channels:
+        print(
+            f'{LFP_rec_ch_names[ch]}: {channel_scores[ch]["n_detections"]} artefacts, '
+            f'SNR {channel_scores[ch]["snr"]:.1f}, ratio_max_sd {channel_scores[ch]["ratio_max_sd"]:.1f}'
+        )
+    print(f'Set "LFP_ch_index" to {ch_i} in the config file to use this channel in the timeshift analysis.')
+
+    return ch_i
+
+
 def _is_channel_in_list(
 		channel_array, 
 		desired_channel_name
@@ -102,4 +417,112 @@ def _is_channel_in_list(
     if desired_channel_name.lower() in (channel.lower() for channel in channel_array):
         return True
     else:
-        return False
\ No newline at end of file
+        return False
+
+
+def _scan_poly5_folder(
+        folder,
+        recursive = True
+):
+    """
+    Function that builds a metadata index of all .Poly5 files in a folder,
+    reading only the header and signal description of each file (the
+    samples themselves are never decoded).
+
+    Input:
+        - folder (str): the folder containing the .Poly5 files
+        - recursive (bool): default True, also looks into subfolders
+
+    Returns:
+        - metadata_index (pd.DataFrame): one row per file with its filename,
+            sample_rate, num_channels, num_samples, duration_s, start_time,
+            ch_names and ch_unit_names
+    """
+
+    poly5_files = []
+    for root, dirs, files in os.walk(folder):
+        poly5_files.extend(
+            os.path.join(root, f) for f in files if f.lower().endswith('.poly5')
+        )
+        if not recursive:
+            break
+
+    metadata = []
+    for filename in sorted(poly5_files):
+        try:
+            metadata.append(poly5_reader.read_metadata(filename))
+        except Exception as e:
+            print(f'Could not read the header of {filename}: {e}')
+
+    columns = ['filename', 'sample_rate', 'num_channels', 'num_samples', 
+               'duration_s', 'start_time', 'ch_names', 'ch_unit_names']
+    metadata_index = pd.DataFrame(metadata, columns=columns)
+
+    return metadata_index
+
+
+def _read_poly5_file(
+        filename,
+        channels = None,
+        cache_dir = None
+):
+    """
+    Function that decodes a single .Poly5 file and returns its samples 
+    and metadata (module-level so that it can be sent to worker processes).
+    """
+
+    TMSi_data = poly5_reader.Poly5Reader(
+        filename, 
+        channels=channels, 
+        verbose=False, 
+        cache_dir=cache_dir
+    )
+    metadata = TMSi_data.metadata()
+    metadata['ch_names'] = TMSi_data.ch_names
+    metadata['ch_unit_names'] = TMSi_data.ch_unit_names
+
+    return TMSi_data.samples, metadata
+
+
+def _load_poly5_files(
+        filenames,
+        n_workers = None,
+        use_processes = False,
+        channels = None,
+        cache_dir = None
+):
+    """
+    Function that loads several .Poly5 recordings concurrently, e.g. all
+    external recordings of a cohort.
+
+    Input:
+        - filenames (list of str): paths to the .Poly5 files
+        - n_workers (int): number of concurrent workers, defaults to the 
+            number of CPUs
+        - use_processes (bool): default False, decode the files in a pool of
+            processes instead of threads (the decoded arrays are then copied 
+            back to the main process)
+        - channels (list): if given, only these channels (names or indices)
+            are decoded in every file
+        - cache_dir (str): if given, the decoded-data cache folder, cached 
+            recordings are returned as memory-mapped arrays
+
+    Returns:
+        - recordings (list of tuples): (samples, metadata) for each file, in 
+            the same order as filenames. samples has shape (x, y) 
+            (x channels, y datapoints), metadata is a dict as returned by 
+            Poly5Reader.metadata with the names and units of the loaded channels
+    """
+
+    if n_workers is None:
+        n_workers = os.cpu_count()
+
+    executor = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with executor(max_workers=n_workers) as pool:
+        futures = [
+            pool.submit(_read_poly5_file, filename, channels, cache_dir) 
+            for filename in filenames
+        ]
+        recordings = [future.result() for future in futures]
+
+    return recordings
@@ -129,12 +129,65 @@ def run_resync(
     ### DETECT ARTEFACTS ###
 
     # find artefacts in intracerebral channel
-    art_idx_LFP = artefact.find_LFP_sync_artefact(
-        lfp_data=lfp_sig,
-        sf_LFP=sf_LFP,
-        use_kernel=loaded_dict['kernel'], 
-        consider_first_seconds_LFP=loaded_dict['consider_first_seconds_LFP']
-    )
+    # (with kernel "auto", all kernels are evaluated and the recommended one is used)
+    # (with kernel "template", a template of the artefact is learned from the session, 
+    # or loaded from LFP_template_path, and used as matched filter)
+    # (with stim_search_windows, only around the changes of the stimulation amplitude channels)
+    search_windows = None
+    if loaded_dict['stim_search_windows']:
+        stim_ch_index = [
+            i for i, ch_name in enumerate(LFP_rec_ch_names) if 'STIM' in str(ch_name).upper()
+        ]
+        if len(stim_ch_index) == 0:
+            print('WARNING: no stimulation amplitude channel (named STIM) found,'
+                  ' the artefacts are searched in the whole recording')
+        else:
+            search_windows = artefact.find_stim_change_windows(
+                LFP_array[stim_ch_index], sf_LFP
+            )
+            if len(search_windows) == 0:
+                print('WARNING: the stimulation amplitude does not change,'
+                      ' the artefacts are searched in the whole recording')
+                search_windows = None
+    kernel = loaded_dict['kernel']
+    if kernel == 'auto':
+        kernel_detections, kernel = artefact.find_LFP_sync_artefact_kernel_bank(
+            lfp_data=lfp_sig,
+            sf_LFP=sf_LFP,
+            consider_first_seconds_LFP=loaded_dict['consider_first_seconds_LFP'],
+            search_windows=search_windows
+        )
+        art_idx_LFP = kernel_detections[kernel]['stim_idx']
+    elif kernel == 'template':
+        template = None
+        if loaded_dict['LFP_template_path']:
+            template = np.load(loaded_dict['LFP_template_path'])
+        art_idx_LFP, template = artefact.find_LFP_sync_artefact_template(
+            lfp_data=lfp_sig,
+            sf_LFP=sf_LFP,
+            template=template,
+            consider_first_seconds_LFP=loaded_dict['consider_first_seconds_LFP']
+        )
+        if template is None or not np.all(np.isfinite(template)):
+            raise ValueError('No valid LFP artefact template could be learned,'
+                             ' check the LFP channel or set another kernel')
+        # saved for re-use on later sessions of the same patient
+        np.save(saving_path + '\\LFP_artefact_template.npy', template)
+    else:
+        art_idx_LFP = artefact.find_LFP_sync_artefact(
+            lfp_data=lfp_sig,
+            sf_LFP=sf_LFP,
+            use_kernel=kernel, 
+            consider_first_seconds_LFP=loaded_dict['consider_first_seconds_LFP'],
+            coarse_to_fine=loaded_dict['coarse_to_fine'],
+            search_windows=search_windows,
+            head_tail_only=loaded_dict['head_tail_only']
+        )
+    if loaded_dict['refine_onsets']:
+        # fractional sample indexes, for sub-sample precision
+        art_idx_LFP = artefact.refine_onsets(
+            lfp_sig, art_idx_LFP, use_kernel=template if kernel == 'template' else kernel
+        ).tolist()
 
     art_time_LFP = utils.convert_index_to_time(
         art_idx=art_idx_LFP,
@@ -163,7 +216,7 @@ def run_resync(
     plt.savefig(
         saving_path 
         + '\\Fig3-Intracerebral channel with artefacts detected - kernel ' 
-        + str(loaded_dict['kernel']) 
+        + str(kernel) 
         + '.png',
         bbox_inches='tight'
     )
@@ -195,7 +248,7 @@ def run_resync(
     plt.gcf()
     plt.savefig(saving_path 
                 + '\\Fig4-Intracerebral channel - first artefact detected - kernel ' 
-                + str(loaded_dict['kernel']) 
+                + str(kernel) 
                 + '.png', 
                 bbox_inches='tight'
     )
@@ -206,7 +259,31 @@ def run_resync(
 
     # find artefacts in external bipolar channel:
 
-    filtered_external = preproc.filtering(BIP_channel) # apply a highpass filter at 1Hz to the external bipolar channel (detrending)
+    n_samples_external = len(BIP_channel)
+    head_tail_external = bool(loaded_dict['head_tail_only'] 
+                              and loaded_dict['consider_first_seconds_external'])
+    if head_tail_external:
+        head_stop, tail_start = artefact.external_head_tail_bounds(
+            n_samples_external, sf_external, loaded_dict['consider_first_seconds_external']
+        )
+        # the head and the tail cover the whole recording
+        head_tail_external = head_stop < n_samples_external
+
+    if head_tail_external:
+        # only the first and last seconds are filtered (with 1 second of padding
+        # against the edge effects of the filter), the rest is NaN and not plotted
+        padding = int(sf_external)
+        head_pad = min(padding, n_samples_external - head_stop)
+        tail_pad = min(padding, tail_start)
+        filtered_external = np.full(n_samples_external, np.nan)
+        filtered_external[:head_stop] = preproc.filtering_segment(
+            BIP_channel[:head_stop + head_pad], pad_after=head_pad
+        )
+        filtered_external[tail_start:] = preproc.filtering_segment(
+            BIP_channel[tail_start - tail_pad:], pad_before=tail_pad
+        )
+    else:
+        filtered_external = preproc.filtering(BIP_channel) # apply a highpass filter at 1Hz to the external bipolar channel (detrending)
 
     # PLOT 2 : plot the signal of the channel used for artefact detection in external recording:
     plot.plot_BIP_artefact_channel(
@@ -222,12 +299,26 @@ def run_resync(
         plt.close()
 
 
-    art_idx_BIP = artefact.find_external_sync_artefact(
-        data=filtered_external, 
-        sf_external=sf_external,
-        ignore_first_seconds_external=loaded_dict['ignore_first_seconds_external'], 
-        consider_first_seconds_external=loaded_dict['consider_first_seconds_external']
-    )
+    if head_tail_external:
+        art_idx_BIP = artefact.find_external_sync_artefact_head_tail(
+            head=filtered_external[:head_stop],
+            tail=filtered_external[tail_start:],
+            sf_external=sf_external,
+            n_samples=n_samples_external,
+            consider_first_seconds_external=loaded_dict['consider_first_seconds_external'],
+            ignore_first_seconds_external=loaded_dict['ignore_first_seconds_external'],
+            coarse_to_fine=loaded_dict['coarse_to_fine']
+        )
+    else:
+        art_idx_BIP = artefact.find_external_sync_artefact(
+            data=filtered_external, 
+            sf_external=sf_external,
+            ignore_first_seconds_external=loaded_dict['ignore_first_seconds_external'], 
+            consider_first_seconds_external=loaded_dict['consider_first_seconds_external'],
+            coarse_to_fine=loaded_dict['coarse_to_fine']
+        )
+    if loaded_dict['refine_onsets']:
+        art_idx_BIP = artefact.refine_onsets(filtered_external, art_idx_BIP).tolist()
     
     
     art_time_BIP = utils.convert_index_to_time(
@@ -274,7 +365,7 @@ def run_resync(
         plt.savefig(
             saving_path 
             + '\\Fig5-Intracerebral channel - first artefact detected with correction by user - kernel ' 
-            + str(loaded_dict['kernel']) 
+            + str(kernel) 
             + '.png', 
             bbox_inches='tight'
         )
@@ -410,7 +501,8 @@ def ecg(
         sf_external,
         xmin,
         xmax,
-        SHOW_FIGURES=True
+        SHOW_FIGURES=True,
+        BIP_ch_index=None
 ):
     
     #import settings
@@ -427,9 +519,13 @@ def ecg(
         if not os.path.isdir(saving_path):
             os.makedirs(saving_path)
 
+    # index of the external artefact channel (as returned by the loading function)
+    if BIP_ch_index is None:
+        BIP_ch_index = _find_BIP_ch_index(external_df_offset, loaded_dict['ch_name_BIP'])
+
     # Reselect artefact channels in the aligned (= cropped) files
     LFP_channel_offset = LFP_df_offset.iloc[:, loaded_dict['LFP_ch_index']].to_numpy()  
-    BIP_channel_offset = external_df_offset.iloc[:, loaded_dict['BIP_ch_index']].to_numpy() 
+    BIP_channel_offset = external_df_offset.iloc[:, BIP_ch_index].to_numpy() 
 
     # pre-processing of external bipolar channel before searching artefacts:
     filtered_external_offset = preproc.filtering(BIP_channel_offset)
@@ -467,7 +563,8 @@ def run_timeshift_analysis(
     sf_LFP,
     external_df_offset,
     sf_external,
-    SHOW_FIGURES = True
+    SHOW_FIGURES = True,
+    BIP_ch_index = None
 ):
     
     """"
@@ -485,6 +582,9 @@ def run_timeshift_analysis(
             first artefact (after processing with run_resync function)
         - SHOW_FIGURES: True or False, depending of whether the user
         wants the figures to appear in the notebook directly or not.
+        - BIP_ch_index: index of the external artefact channel, as returned
+        by the loading function (defaults to the index of the channel named 
+        'ch_name_BIP' in config.json)
     
     Output:
         - timeshift: the timeshift of the last detected artefact in
@@ -510,17 +610,37 @@ def run_timeshift_analysis(
 
     ### DETECT ARTEFACTS ###
 
+    if BIP_ch_index is None:
+        BIP_ch_index = _find_BIP_ch_index(external_df_offset, loaded_dict['ch_name_BIP'])
+
     # Reselect artefact channels in the aligned (= cropped) files
     LFP_channel_offset = LFP_df_offset.iloc[:,loaded_dict['LFP_ch_index']].to_numpy()  
-    BIP_channel_offset = external_df_offset.iloc[:,loaded_dict['BIP_ch_index']].to_numpy() 
+    BIP_channel_offset = external_df_offset.iloc[:,BIP_ch_index].to_numpy() 
 
 
     # find artefacts again in cropped intracerebral LFP channel:
-    art_idx_LFP_offset = artefact.find_LFP_sync_artefact(lfp_data=LFP_channel_offset,
-                                                         sf_LFP=sf_LFP,
-                                                         use_kernel=loaded_dict['kernel'],
-                                                         consider_first_seconds_LFP=loaded_dict['consider_first_seconds_LFP']
-    )
+    if loaded_dict['kernel'] == 'auto':
+        kernel_detections, kernel = artefact.find_LFP_sync_artefact_kernel_bank(lfp_data=LFP_channel_offset,
+                                                                                sf_LFP=sf_LFP,
+                                                                                consider_first_seconds_LFP=loaded_dict['consider_first_seconds_LFP']
+        )
+        art_idx_LFP_offset = kernel_detections[kernel]['stim_idx']
+    elif loaded_dict['kernel'] == 'template':
+        template = None
+        if loaded_dict['LFP_template_path']:
+            template = np.load(loaded_dict['LFP_template_path'])
+        art_idx_LFP_offset, _ = artefact.find_LFP_sync_artefact_template(lfp_data=LFP_channel_offset,
+                                                                         sf_LFP=sf_LFP,
+                                                                         template=template,
+                                                                         consider_first_seconds_LFP=loaded_dict['consider_first_seconds_LFP']
+        )
+    else:
+        art_idx_LFP_offset = artefact.find_LFP_sync_artefact(lfp_data=LFP_channel_offset,
+                                                             sf_LFP=sf_LFP,
+                                                             use_kernel=loaded_dict['kernel'],
+                                                             consider_first_seconds_LFP=loaded_dict['consider_first_seconds_LFP'],
+                                                             coarse_to_fine=loaded_dict['coarse_to_fine']
+        )
 
     art_time_LFP_offset = utils.convert_index_to_time(art_idx_LFP_offset,
                                                       sf_LFP
@@ -533,7 +653,8 @@ def run_timeshift_analysis(
     art_idx_BIP_offset = artefact.find_external_sync_artefact(data = filtered_external_offset, 
                                                               sf_external = sf_external,
                                                               ignore_first_seconds_external=loaded_dict['ignore_first_seconds_external'], 
-                                                              consider_first_seconds_external=loaded_dict['consider_first_seconds_external']
+                                                              consider_first_seconds_external=loaded_dict['consider_first_seconds_external'],
+                                                              coarse_to_fine=loaded_dict['coarse_to_fine']
     )
     art_time_BIP_offset = utils.convert_index_to_time(art_idx_BIP_offset, 
                                                       sf_external
@@ -689,3 +810,22 @@ def run_timeshift_analysis(
 
 
 
+def _find_BIP_ch_index(
+    external_df_offset,
+    ch_name_BIP
+):
+    """
+    Function that returns the index of the external artefact channel in the
+    cropped external recording, from its name (ch_name_BIP in config.json).
+    If the channel was found automatically by the loading function 
+    (ch_name_BIP "auto" or not in the recording), its index must be given.
+    """
+
+    ch_names = list(external_df_offset.columns)
+    if ch_name_BIP not in ch_names:
+        raise ValueError(
+            f'The channel {ch_name_BIP} is not in the external recording, please '
+            'give BIP_ch_index as returned by loading._load_TMSi_artefact_channel'
+        )
+
+    return ch_names.index(ch_name_BIP)
@@ -15,3 +15,22 @@ def filtering(
     filteredHighPass = scipy.signal.filtfilt(b, a, BIP_channel)
 
     return filteredHighPass
+
+
+
+def filtering_segment(
+        segment,
+        pad_before = 0,
+        pad_after = 0
+):
+    """
+    This function applies the same highpass filter as filtering() to a
+    segment of the BIP channel, and removes pad_before samples at the
+    beginning and pad_after samples at the end. These samples are only 
+    read to avoid the edge effects of the filter inside the segment, so
+    that the result matches the filtered whole channel.
+    """
+
+    filtered_segment = filtering(segment)
+
+    return filtered_segment[pad_before: len(filtered_segment) - pad_after]
@@ -35,12 +35,16 @@ limitations under the License.
 import numpy as np
 import struct
 import datetime
+import warnings
 import mne
 import tkinter as tk
 from tkinter import filedialog
 
+import functions.data_cache as data_cache
+
 class Poly5Reader: 
-    def __init__(self, filename=None, readAll = True):
+    def __init__(self, filename=None, readAll = True, mmap = False, dtype = np.float32,
+                 channels = None, verbose = True, cache_dir = None, cache_max_size = 20e9):
         if filename==None:
             root = tk.Tk()
 
@@ -49,21 +53,39 @@ class Poly5Reader:
             
         self.filename = filename
         self.readAll = readAll
-        print('Reading file ', filename)
-        self._readFile(filename)
+        self.mmap = mmap
+        self.dtype = dtype
+        self._selected_channels = channels
+        self.verbose = verbose
+        self.cache_dir = cache_dir
+        self.cache_max_size = cache_max_size
+        # set once self.samples has been scaled to volts in place
+        self._in_volts = False
+        if self.verbose:
+            print('Reading file ', filename)
+        if self.mmap:
+            self._mapFile(filename)
+        else:
+            self._readFile(filename)
         
-    def read_data_MNE(self,) -> mne.io.RawArray:
+    def read_data_MNE(self, copy = True) -> mne.io.RawArray:
         """Return MNE RawArray given internal channel names and types
 
+        Parameters
+        ----------
+        copy : bool
+            If False and the samples are already float64, they are scaled in
+            place and handed to MNE without any copy (self.samples then holds
+            volts, also for later calls). See read_data_array.
+
         Returns
         -------
         mne.io.RawArray
         """
 
-        streams = self.channels
         fs = self.sample_rate
-        labels = [s._Channel__name for s in streams]
-        units = [s._Channel__unit_name for s in streams]
+        labels = self.ch_names
+        units = self.ch_unit_names
 
         type_options = [
             "ecg",
@@ -93,11 +115,55 @@ class Poly5Reader:
 
         info = mne.create_info(ch_names=labels, sfreq=fs, ch_types=types_clean)
 
-        # convert from microvolts to volts if necessary
-        scale = np.array([1e-6 if u == "µVolt" else 1 for u in units])
+        # float64 data is used as is by RawArray
+        samples, _, _ = self.read_data_array(copy=copy)
 
-        raw = mne.io.RawArray(self.samples * np.expand_dims(scale, axis=1), info)
+        raw = mne.io.RawArray(samples, info)
         return raw
+
+    def read_data_array(self, copy = True):
+        """Return the samples in volts as a float64 array, without MNE.
+
+        The microvolt channels are scaled in place, one channel at a time, 
+        so at most one float64 copy of the recording is made (none if the 
+        samples are already float64 and copy is False).
+
+        Parameters
+        ----------
+        copy : bool
+            If False, float64 samples held by the reader are scaled in place
+            and self.samples then holds volts. They are not scaled again by
+            later calls.
+
+        Returns
+        -------
+        samples : np.ndarray, shape (channels, samples)
+        ch_names : list of str
+        sample_rate : int
+        """
+        if self.mmap:
+            samples = self._readMapped(self.channel_indices, 0, self.num_samples, np.float64)
+        elif (copy or self.samples.dtype != np.float64 
+                or not self.samples.flags.writeable):
+            samples = self.samples.astype(np.float64, order='C')
+        else:
+            samples = self.samples
+
+        # self.samples already holds volts after an in-place call
+        if not self.mmap and self._in_volts:
+            return samples, self.ch_names, self.sample_rate
+
+        # convert from microvolts to volts if necessary
+        uV_channels = [i for i, u in enumerate(self.ch_unit_names) if u == "µVolt"]
+        if len(uV_channels) == len(self.ch_unit_names):
+            samples *= 1e-6
+        else:
+            for i in uV_channels:
+                samples[i] *= 1e-6
+        if not self.mmap and samples is self.samples:
+            self._in_volts = True
+
+        return samples, self.ch_names, self.sample_rate
         
     def _readFile(self, filename):
         try:
@@ -106,46 +172,48 @@ class Poly5Reader:
             try:    
                 self._readHeader(file_obj)
                 self.channels = self._readSignalDescription(file_obj)
-                self._myfmt = 'f' * self.num_channels*self.num_samples_per_block
-                self._buffer_size = self.num_channels*self.num_samples_per_block
+                self._data_offset = file_obj.tell()
+                self._next_block = 0
+                self._setSelectedChannels(self._selected_channels)
                 
                 if self.readAll:
-                    sample_buffer = np.zeros(self.num_channels * self.num_samples)
-     
-                    for i in range(self.num_data_blocks):
-                        print('\rProgress: % 0.1f %%' %(100*i/self.num_data_blocks), end="\r")
-                         
-                        # Check whether final data block is filled completely or not
-                        if i == self.num_data_blocks-1:
-                            _final_block_size = self.num_samples / self.num_data_blocks
-                            if _final_block_size % self.num_samples_per_block != 0:
-                                data_block = self._readSignalBlock(file_obj, 
-                                                                   buffer_size = (self.num_samples%self.num_samples_per_block) * self.num_channels, 
-                                                                   myfmt = 'f' * (self.num_samples%self.num_samples_per_block) * self.num_channels)
-                            else:
-                                data_block = self._readSignalBlock(file_obj, self._buffer_size, self._myfmt)
-                        else:
-                            data_block = self._readSignalBlock(file_obj, self._buffer_size, self._myfmt)
-                        
-                        # Get indices that need to be filled in the samples array
-                        i1 = i * self.num_samples_per_block * self.num_channels
-                        i2 = (i+1) * self.num_samples_per_block * self.num_channels
-                        
-                        # Correct for final data block if this is not fully filled
-                        if i2 >= self.num_samples * self.num_channels:
-                            i2 = self.num_samples * self.num_channels
-                        
-                        # Insert the read data_block into the sample_buffer array
-                        sample_buffer[i1:i2] = data_block
-                       
-                    samples=np.transpose(np.reshape(sample_buffer, [self.num_samples, self.num_channels]))
-                    
-                    self.ch_names = [s._Channel__name for s in self.channels]
-                    self.ch_unit_names = [s._Channel__unit_name for s in self.channels]
+                    cached_samples = None
+                    if self.cache_dir is not None:
+                        try:
+                            cached_samples, _ = data_cache.load_from_cache(filename, self.cache_dir)
+                        except (OSError, ValueError) as e:
+                            # a broken cache only costs the decoding time
+                            warnings.warn(f'Could not load from cache, reading the file: {e}')
+
+                    if cached_samples is not None:
+                        # decoded samples are memory-mapped from the cache
+                        if self._selected_channels is not None:
+                            cached_samples = cached_samples[self.channel_indices]
+                        samples = cached_samples.astype(self.dtype, copy=False)
+                        if self.verbose:
+                            print('Data loaded from cache.')
+                    elif self._selected_channels is None:
+                        samples = self._readAllBlocks(file_obj, self.dtype)
+                        if self.cache_dir is not None:
+                            try:
+                                data_cache.save_to_cache(filename, samples, self.metadata(),
+                                                         self.cache_dir, self.cache_max_size)
+                            except OSError as e:
+                                warnings.warn(f'Could not save to cache: {e}')
+                    else:
+                        # strided read of the selected channels only
+                        self._mapBlocks(filename, self._data_offset)
+                        samples = self._readMapped(self.channel_indices, 0, 
+                                                   self.num_samples, self.dtype)
+                        self._blocks = None
+                        self._final_block = None
                     
                     self.samples=samples
-                    print('Done reading data.')
-                    self.file_obj.close()
+                    if self.verbose:
+                        print('Done reading data.')
+                
+                # the data is read with separate file handles from here on
+                self.file_obj.close()
                     
             except Exception as e:
                 print('Reading data failed, because of the following error:\n')
@@ -154,22 +222,293 @@ class Poly5Reader:
             print('Could not open file. ')
         
         
-    def readSamples(self, n_blocks = None):
-        "Function to read a subset of sample blocks from a file"
-        if n_blocks==None:
-            n_blocks = self.num_data_blocks
-            
-        sample_buffer = np.zeros(self.num_channels*n_blocks*self.num_samples_per_block)
-     
-        for i in range(n_blocks):
-            data_block = self._readSignalBlock(self.file_obj, self._buffer_size, self._myfmt)
-            i1 = i * self.num_samples_per_block * self.num_channels
-            i2 = (i+1) * self.num_samples_per_block * self.num_channels
-            sample_buffer[i1:i2] = data_block
+    def _readAllBlocks(self, f, dtype = np.float32):
+        """Decode all remaining data blocks of the file in one go.
+
+        The data region is read at once and viewed as structured blocks
+        (see _blockDtype), so the samples of every block are decoded by a
+        single numpy copy instead of one struct.unpack call per block.
+
+        Returns:
+            - samples (np.ndarray with shape: (channels, samples)), in the
+                native float32 of the file unless another dtype is given
+        """
+        spb = self.num_samples_per_block
+        n_full_blocks = self.num_samples // spb
+        n_final_samples = self.num_samples % spb
+        block_dtype = self._blockDtype(spb)
+        final_dtype = self._blockDtype(n_final_samples)
+
+        n_bytes = n_full_blocks * block_dtype.itemsize
+        if n_final_samples > 0:
+            n_bytes += final_dtype.itemsize
+        raw = f.read(n_bytes)
+
+        # samples are stored interleaved, so fill a (samples, channels) buffer
+        # and return its transpose
+        sample_buffer = np.empty((self.num_samples, self.num_channels), dtype=dtype)
+        blocks = np.frombuffer(raw, dtype=block_dtype, count=n_full_blocks)
+        sample_buffer[:n_full_blocks*spb] = blocks['data'].reshape(-1, self.num_channels)
+        if n_final_samples > 0:
+            final_block = np.frombuffer(raw, dtype=final_dtype, count=1,
+                                        offset=n_full_blocks * block_dtype.itemsize)
+            sample_buffer[n_full_blocks*spb:] = final_block['data'][0]
+
+        return np.transpose(sample_buffer)
+
+    def _mapFile(self, filename):
+        """Map the data blocks of the file without reading them into memory.
+
+        The data region is viewed as an array of structured blocks, each made
+        of the 86-byte block header followed by the interleaved float32
+        samples, so that channels can be sliced out of the file on demand.
+        The final block of a file is usually shorter than the others and is
+        mapped separately.
+        """
+        try:
+            with open(filename, "rb") as file_obj:
+                self._readHeader(file_obj)
+                self.channels = self._readSignalDescription(file_obj)
+                self._data_offset = file_obj.tell()
+        except OSError:
+            print('Could not open file. ')
+            return
+
+        self._next_block = 0
+        self._setSelectedChannels(self._selected_channels)
+        self._mapBlocks(filename, self._data_offset)
+        if self.verbose:
+            print('Done mapping data.')
+
+    def _mapBlocks(self, filename, data_offset):
+        "Map the full data blocks and the final, shorter block starting at data_offset"
+        n_full_blocks = self.num_samples // self.num_samples_per_block
+        n_final_samples = self.num_samples % self.num_samples_per_block
+
+        block_dtype = self._blockDtype(self.num_samples_per_block)
+        if n_full_blocks > 0:
+            self._blocks = np.memmap(filename, dtype=block_dtype, mode='r',
+                                     offset=data_offset, shape=(n_full_blocks,))
+        else:
+            self._blocks = np.zeros(0, dtype=block_dtype)
+
+        if n_final_samples > 0:
+            self._final_block = np.memmap(filename, dtype=self._blockDtype(n_final_samples), 
+                                          mode='r', shape=(1,),
+                                          offset=data_offset + n_full_blocks * block_dtype.itemsize)
+        else:
+            self._final_block = None
+
+    def _blockDtype(self, n_samples):
+        "Structured dtype of one data block holding n_samples samples of every channel"
+        return np.dtype([('header', 'V86'),
+                         ('data', '<f4', (n_samples, self.num_channels))])
+
+    def _channelIndex(self, ch):
+        "Return the index of a channel in the file given either its index or its name"
+        if isinstance(ch, str):
+            return [s._Channel__name for s in self.channels].index(ch)
+        return int(ch)
+
+    def _setSelectedChannels(self, channels):
+        """Set the indices, names and units of the channels held by the reader
+        (all channels of the file if channels is None)."""
+        if channels is None:
+            self.channel_indices = list(range(self.num_channels))
+        else:
+            self.channel_indices = [self._channelIndex(ch) for ch in channels]
+        self.ch_names = [self.channels[i]._Channel__name for i in self.channel_indices]
+        self.ch_unit_names = [self.channels[i]._Channel__unit_name for i in self.channel_indices]
+
+    def channelView(self, ch):
+        """Return a zero-copy view on one channel of a memory-mapped file.
+
+        The view has shape (number of full blocks, samples per block) and
+        covers every sample except those of the final, shorter block (use
+        readChannel to get the complete channel as a single array).
+
+        Input:
+            - ch: index or name of the channel
+        """
+        if not self.mmap:
+            raise ValueError('channelView requires the file to be opened with mmap=True')
+        return self._blocks['data'][:, :, self._channelIndex(ch)]
+
+    def readChannel(self, ch, start = 0, stop = None):
+        """Return one channel of the file as a 1d array.
+
+        Only the requested channel and sample range are copied from the file.
+
+        Input:
+            - ch: index or name of the channel
+            - start, stop: sample range to read, defaults to the whole channel
+        """
+        return self.readChannels([ch], start, stop)[0]
+
+    def readChannels(self, channels = None, start = 0, stop = None):
+        """Read a subset of channels from the file with strided reads.
+
+        This also works on a reader that was opened with only some channels,
+        e.g. to read the remaining channels once they are needed.
+
+        Input:
+            - channels: list of channel indices or names, defaults to all channels
+            - start, stop: sample range to read, defaults to the whole recording
+
+        Returns:
+            - samples (np.ndarray with shape: (channels, samples))
+        """
+        if channels is None:
+            channels = range(self.num_channels)
+        if stop is None:
+            stop = self.num_samples
+        channel_indices = [self._channelIndex(ch) for ch in channels]
+
+        if self.mmap:
+            return self._readMapped(channel_indices, start, stop, self.dtype)
+
+        self._mapBlocks(self.filename, self._data_offset)
+        samples = self._readMapped(channel_indices, start, stop, self.dtype)
+        self._blocks = None
+        self._final_block = None
+        return samples
+
+    def metadata(self):
+        """Return the recording information parsed from the file header and
+        signal description as a dict (sample rate, channel names and units,
+        start time, number of samples and duration in seconds)."""
+        return {
+            'filename': self.filename,
+            'sample_rate': self.sample_rate,
+            'num_channels': self.num_channels,
+            'num_samples': self.num_samples,
+            'duration_s': self.num_samples / self.sample_rate,
+            'start_time': self.start_time,
+            'ch_names': [s._Channel__name for s in self.channels],
+            'ch_unit_names': [s._Channel__unit_name for s in self.channels],
+        }
+
+    def _readMapped(self, channels, start, stop, dtype = np.float32):
+        "Copy the given channels between samples start and stop out of the mapped blocks"
+        channels = list(channels)
+        spb = self.num_samples_per_block
+        n_full = self._blocks.shape[0] * spb
+        start = max(0, start)
+        stop = min(stop, self.num_samples)
+        samples = np.empty((len(channels), max(0, stop - start)), dtype=dtype)
+
+        if start < min(stop, n_full):
+            full_stop = min(stop, n_full)
+            b0 = start // spb
+            b1 = -(-full_stop // spb)
+            data = self._blocks['data'][b0:b1][:, :, channels].reshape(-1, len(channels))
+            samples[:, :full_stop - start] = data[start - b0*spb:full_stop - b0*spb].T
+
+        if stop > n_full:
+            final_start = max(start, n_full)
+            data = self._final_block['data'][0][final_start - n_full:stop - n_full][:, channels]
+            samples[:, final_start - start:] = data.T
+
+        return samples
         
-        samples = np.transpose(np.reshape(sample_buffer, [self.num_samples_per_block*(i+1), self.num_channels]))
+    def readSamples(self, n_blocks = None, first_block = None):
+        """Function to read a subset of sample blocks from a file.
+
+        Input:
+            - n_blocks: number of blocks to read, defaults to all remaining blocks
+            - first_block: index of the first block to read, defaults to the
+                block following the ones returned by the previous call
+
+        Returns:
+            - samples (np.ndarray with shape: (channels, samples)), the final 
+                block can be shorter than the others
+        """
+        if first_block is None:
+            first_block = self._next_block
+        if n_blocks is None:
+            n_blocks = self.num_data_blocks - first_block
+
+        with open(self.filename, "rb") as file_obj:
+            samples = self._readBlocks(file_obj, first_block, n_blocks, self.channel_indices)
+        self._next_block = min(first_block + n_blocks, self.num_data_blocks)
+
+        return np.transpose(samples)
+
+    def iterSamples(self, chunk_size, start = 0, stop = None, channels = None):
+        """Generator reading the file in chunks of a fixed number of samples.
+
+        Only the blocks overlapping the current chunk are read from disk, so
+        memory use is bounded by the chunk size whatever the file length.
+
+        Input:
+            - chunk_size: number of samples per chunk (the last chunk can be 
+                shorter)
+            - start: index of the first sample to read, to seek into the file
+            - stop: index after the last sample to read, defaults to the end 
+                of the file
+            - channels: list of channel indices or names, defaults to the 
+                channels selected when opening the reader
+
+        Yields:
+            - offset (int): absolute index of the first sample of the chunk
+            - chunk (np.ndarray with shape: (channels, chunk_size))
+        """
+        if stop is None:
+            stop = self.num_samples
+        stop = min(stop, self.num_samples)
+        if channels is None:
+            channel_indices = self.channel_indices
+        else:
+            channel_indices = [self._channelIndex(ch) for ch in channels]
+        spb = self.num_samples_per_block
+
+        with open(self.filename, "rb") as file_obj:
+            for offset in range(max(0, start), stop, chunk_size):
+                end = min(offset + chunk_size, stop)
+                first_block = offset // spb
+                n_blocks = -(-end // spb) - first_block
+                data = self._readBlocks(file_obj, first_block, n_blocks, channel_indices)
+                chunk = data[offset - first_block*spb:end - first_block*spb]
+                yield offset, np.transpose(chunk)
+
+    def _readBlocks(self, f, first_block, n_blocks, channels):
+        """Read n_blocks data blocks starting at block first_block (including
+        the final, shorter block if it is in range) for the given channels.
+        Blocks past the end of the file are ignored, so a read at the end of
+        the file returns no samples.
+
+        Returns:
+            - samples (np.ndarray with shape: (samples, channels))
+        """
+        spb = self.num_samples_per_block
+        n_full_blocks = self.num_samples // spb
+        n_final_samples = self.num_samples % spb
+        block_dtype = self._blockDtype(spb)
+        final_dtype = self._blockDtype(n_final_samples)
+
+        # nothing is read past the end of the file
+        n_blocks = max(0, min(n_blocks, -(-self.num_samples // spb) - first_block))
+        last_block = min(first_block + n_blocks, n_full_blocks)
+        n_full_read = max(0, last_block - first_block)
+        read_final = (n_final_samples > 0 
+                      and first_block <= n_full_blocks < first_block + n_blocks)
+
+        f.seek(self._data_offset + first_block * block_dtype.itemsize)
+        n_bytes = n_full_read * block_dtype.itemsize
+        if read_final:
+            n_bytes += final_dtype.itemsize
+        raw = f.read(n_bytes)
+
+        n_read = n_full_read*spb + (n_final_samples if read_final else 0)
+        samples = np.empty((n_read, len(channels)), dtype=self.dtype)
+        blocks = np.frombuffer(raw, dtype=block_dtype, count=n_full_read)
+        samples[:n_full_read*spb] = blocks['data'][:, :, channels].reshape(-1, len(channels))
+        if read_final:
+            final_block = np.frombuffer(raw, dtype=final_dtype, count=1,
+                                        offset=n_full_read * block_dtype.itemsize)
+            samples[n_full_read*spb:] = final_block['data'][0][:, channels]
+
         return samples
-    
             
     def _readHeader(self, f):
         header_data = struct.unpack("=31sH81phhBHi4xHHHHHHHiHHH64x", f.read(217))
@@ -188,7 +527,7 @@ class Poly5Reader:
             print('This is not a Poly5 file.')
         elif  version_number != 203:
             print('Version number of file is invalid.')
-        else:
+        elif self.verbose:
             print('\t Number of samples:  %s ' %self.num_samples)
             print('\t Number of channels:  %s ' % self.num_channels)
             print('\t Sample rate: %s Hz' %self.sample_rate)
@@ -207,17 +546,26 @@ class Poly5Reader:
         
             
     
-    def _readSignalBlock(self, f, buffer_size, myfmt):
-        f.read(86)
-        sampleData = f.read(buffer_size*4)
-        DataBlock = struct.unpack(myfmt, sampleData)
-        SignalBlock = np.asarray(DataBlock)
-        return SignalBlock
-    
     def close(self):
-        self.file_obj.close()
+        if self.mmap:
+            self._blocks = None
+            self._final_block = None
+        else:
+            self.file_obj.close()
         
 
+def read_metadata(filename):
+    """Read only the header and signal description of a Poly5 file.
+
+    Input:
+        - filename: path to the .Poly5 file
+
+    Returns:
+        - dict with the recording information, see Poly5Reader.metadata
+    """
+    return Poly5Reader(filename, readAll=False, verbose=False).metadata()
+
+
 class Channel:
     """ 'Channel' represents a device channel. It has the next properties:
 
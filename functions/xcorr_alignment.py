@@ -0,0 +1,187 @@
+"""
+Alignment of the intracerebral and external recordings by
+cross-correlation of their artefact envelopes
+"""
+
+import numpy as np
+from scipy import fft
+
+
+# common sampling frequency of the artefact envelopes (Hz)
+ENVELOPE_SF = 100
+
+
+
+def xcorr_align(
+    lfp_data: np.ndarray,
+    sf_LFP,
+    external_data: np.ndarray,
+    sf_external,
+    envelope_sf: int = ENVELOPE_SF,
+    max_lag_seconds=None,
+    windows_LFP: list = None
+):
+    """
+    Function that aligns the intracerebral and external recordings in one
+    call, without detecting each artefact onset: the artefact envelopes of
+    both signals are computed at a common sampling frequency, and the lag
+    between them is estimated by FFT cross-correlation over the whole
+    recording (or over selected windows).
+    This is an alternative to find_LFP_sync_artefact/find_external_sync_artefact
+    when the individual onsets are ambiguous, or a way to double-check them
+    (the offset should be close to art_time_BIP[0] - art_time_LFP[0]).
+
+    Inputs:
+        - lfp_data: single LFP channel as np.ndarray (or 2d array with one
+            session per row, padded to the same length)
+        - sf_LFP (int): sampling frequency of intracranial recording
+        - external_data: single external channel as np.ndarray, filtered
+            (see preprocessing.filtering), or 2d array with one session per row
+        - sf_external (int): sampling frequency of external recording
+        - envelope_sf (int): common sampling frequency of the envelopes,
+            which is also the resolution of the offset
+        - max_lag_seconds: if given, only offsets between -max_lag_seconds
+            and max_lag_seconds are considered
+        - windows_LFP: if given, list of (start, stop) windows in seconds of
+            the LFP recording (e.g. around the stimulation changes), only
+            these parts of the LFP envelope are used
+
+    Returns:
+        - offset (float, or np.ndarray for several sessions): time (in s) of
+            an event in the external recording minus its time in the LFP
+            recording
+        - confidence (float, or np.ndarray): between 0 and 1, 1 minus the ratio
+            between the second highest and the highest cross-correlation peak
+            (close to 0 if the alignment is ambiguous)
+    """
+
+    envelope_LFP = artefact_envelope(lfp_data, sf_LFP, envelope_sf)
+    envelope_external = artefact_envelope(external_data, sf_external, envelope_sf)
+
+    if windows_LFP:
+        in_windows = np.zeros(envelope_LFP.shape[-1], dtype=bool)
+        for start, stop in windows_LFP:
+            in_windows[int(start * envelope_sf): int(np.ceil(stop * envelope_sf))] = True
+        envelope_LFP = envelope_LFP * in_windows
+
+    return estimate_lag(
+        envelope_external, envelope_LFP, envelope_sf, max_lag_seconds
+    )
+
+
+
+def artefact_envelope(
+    data: np.ndarray,
+    sf,
+    envelope_sf: int = ENVELOPE_SF
+):
+    """
+    Function that computes the artefact envelope of a signal at the
+    sampling frequency envelope_sf. The envelope is the maximum of the
+    absolute deviation to the median in each bin of 1/envelope_sf seconds,
+    scaled by the noise level (median absolute deviation) and log-compressed,
+    so that recorders with different units and artefact shapes become
+    comparable. Its absolute derivative is returned: it is high at the start
+    and end of each artefact (steep steps in LFP, pulse trains in external
+    recordings), and normalised to zero mean and unit norm.
+
+    Inputs:
+        - data: single channel as np.ndarray, or 2d array (one signal per row)
+        - sf (int): sampling frequency of the signal
+        - envelope_sf (int): sampling frequency of the envelope
+
+    Returns:
+        - envelope: np.ndarray with the same number of dimensions as data,
+            and floor(n_samples * envelope_sf / sf) samples per signal
+    """
+
+    data = np.asarray(data, dtype=float)
+    n_bins = int(data.shape[-1] * envelope_sf / sf)
+    bin_starts = (np.arange(n_bins) * sf / envelope_sf).astype(int)
+
+    deviation = np.abs(data - np.median(data, axis=-1, keepdims=True))
+    noise_level = np.median(deviation, axis=-1, keepdims=True)
+    noise_level[noise_level == 0] = 1
+    envelope = np.maximum.reduceat(deviation, bin_starts, axis=-1)
+    envelope = np.log1p(envelope / noise_level)
+
+    envelope = np.abs(np.diff(envelope, axis=-1, prepend=envelope[..., :1]))
+    envelope = envelope - np.mean(envelope, axis=-1, keepdims=True)
+    norm = np.linalg.norm(envelope, axis=-1, keepdims=True)
+    norm[norm == 0] = 1
+
+    return envelope / norm
+
+
+
+def estimate_lag(
+    envelope_a: np.ndarray,
+    envelope_b: np.ndarray,
+    envelope_sf: int,
+    max_lag_seconds=None,
+    exclusion_seconds: float = 1
+):
+    """
+    Function that estimates the lag between two envelopes with the same
+    sampling frequency by FFT cross-correlation:
+    xcorr[k] = sum(envelope_a[i + k] * envelope_b[i]), which is maximal when
+    an event at time t in envelope_b is found at t + lag in envelope_a.
+    Several pairs of envelopes (one per row of 2d arrays) are processed in
+    a single batched FFT.
+
+    Inputs:
+        - envelope_a, envelope_b: np.ndarray (1d, or 2d with one envelope
+            per row, envelope_b can also be 1d and shared by all rows)
+        - envelope_sf (int): sampling frequency of the envelopes
+        - max_lag_seconds: if given, only lags between -max_lag_seconds
+            and max_lag_seconds are considered
+        - exclusion_seconds: the second highest peak used for the
+            confidence is searched further than this from the highest peak
+
+    Returns:
+        - lag (float, or np.ndarray): lag in seconds, refined between samples
+            by a parabolic fit of the cross-correlation peak
+        - confidence (float, or np.ndarray): 1 minus the ratio between the
+            second highest and the highest peak
+    """
+
+    envelope_a = np.atleast_2d(envelope_a)
+    envelope_b = np.atleast_2d(envelope_b)
+    n_a, n_b = envelope_a.shape[-1], envelope_b.shape[-1]
+    n_fft = fft.next_fast_len(n_a + n_b - 1, real=True)
+
+    xcorr = fft.irfft(
+        fft.rfft(envelope_a, n_fft, axis=-1) * np.conj(fft.rfft(envelope_b, n_fft, axis=-1)),
+        n_fft, axis=-1
+    )
+    # reorder from lag -(n_b - 1) to lag n_a - 1
+    xcorr = np.concatenate((xcorr[:, n_fft - n_b + 1:], xcorr[:, :n_a]), axis=-1)
+    lags = np.arange(-(n_b - 1), n_a)
+    if max_lag_seconds is not None:
+        in_range = np.abs(lags) <= max_lag_seconds * envelope_sf
+        xcorr, lags = xcorr[:, in_range], lags[in_range]
+
+    rows = np.arange(len(xcorr))
+    i_peak = np.argmax(xcorr, axis=-1)
+    peak = xcorr[rows, i_peak]
+
+    # parabolic interpolation of the peak
+    left = xcorr[rows, np.maximum(i_peak - 1, 0)]
+    right = xcorr[rows, np.minimum(i_peak + 1, xcorr.shape[-1] - 1)]
+    curvature = left - 2 * peak + right
+    shift = np.zeros(len(xcorr))
+    fit = (curvature < 0) & (i_peak > 0) & (i_peak < xcorr.shape[-1] - 1)
+    shift[fit] = .5 * (left[fit] - right[fit]) / curvature[fit]
+    lag = (lags[i_peak] + shift) / envelope_sf
+
+    # confidence: highest peak compared to the highest one further away
+    far = np.abs(lags[None, :] - lags[i_peak][:, None]) > exclusion_seconds * envelope_sf
+    second_peak = np.max(np.where(far, xcorr, -np.inf), axis=-1)
+    confidence = np.zeros(len(xcorr))
+    positive = peak > 0
+    confidence[positive] = 1 - np.maximum(second_peak[positive], 0) / peak[positive]
+
+    if lag.shape[0] == 1:
+        return float(lag[0]), float(confidence[0])
+
+    return lag, confidence
@@ -0,0 +1,54 @@
+"""
+Check that find_LFP_sync_artefact_kernel_bank does not recommend a kernel
+locked onto noise peaks, even when its dot-products have a higher
+ratio_max_sd than those of the kernel finding the artefacts
+"""
+
+import numpy as np
+import pytest
+
+from functions.find_artefacts import LFP_KERNELS, find_LFP_sync_artefact_kernel_bank
+
+
+SF_LFP = 250
+ONSETS = (1, 2.5, 4, 40, 60, 80, 100)  # artefact starts in seconds
+
+
+
+def _synthetic_lfp(seed, duration=120, sf=SF_LFP):
+    """
+    Noise with a burst of large noise (e.g. movement) between 10 and 15
+    seconds, and stimulation artefacts (exponential decay at stim on and 
+    off, 0.5 s apart) at ONSETS
+    """
+
+    rng = np.random.default_rng(seed)
+    data = rng.standard_normal(sf*duration) * 5
+    data[sf*10:sf*15] = rng.standard_normal(sf*5) * 40
+    k = np.arange(len(data))
+    for t in ONSETS:
+        amplitude = 300 * (1 + .05*rng.standard_normal())
+        on = int(t*sf) + 1
+        off = on + sf // 2
+        data[on:] += amplitude * np.exp(-(k[on:] - on) / 50)
+        data[off:] -= amplitude * np.exp(-(k[off:] - off) / 50)
+
+    return data
+
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_kernel_locked_onto_noise_is_not_recommended(seed):
+    # alternating kernel: blind to the slow artefacts, it picks up the noise burst
+    kernels = {'2': LFP_KERNELS['2'], 'noise': np.tile([1., -1.], 100)}
+    detections, recommended_kernel = find_LFP_sync_artefact_kernel_bank(
+        _synthetic_lfp(seed), SF_LFP, kernels=kernels
+    )
+
+    # the noise kernel stands out more in its own dot-products ...
+    assert (detections['noise']['ratio_max_sd'] * detections['noise']['height_consistency']
+            > detections['2']['ratio_max_sd'] * detections['2']['height_consistency'])
+    # ... but its detections are much closer to the noise level
+    assert detections['noise']['snr'] < detections['2']['snr'] / 3
+    assert recommended_kernel == '2'
+    assert list(detections['2']['stim_idx']) == [int(t*SF_LFP) - 1 for t in ONSETS]
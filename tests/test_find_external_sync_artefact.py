@@ -0,0 +1,128 @@
+"""
+Regression check: find_external_sync_artefact must return the same
+artefact starts as the original sample-by-sample loop
+"""
+
+import json
+
+import numpy as np
+import pytest
+
+from functions.find_artefacts import find_external_sync_artefact
+
+
+SF_EXTERNAL = 4000
+THRESH_BIP = -0.001
+
+
+
+def _baseline_find_external_sync_artefact(
+    data, sf_external, ignore_first_seconds_external=None, consider_first_seconds_external=None
+):
+    """ Original loop of find_external_sync_artefact (reference) """
+
+    index_artefact_start_external = []
+    stimON = False
+    thresh_BIP = THRESH_BIP
+    start_index = 0
+    stop_index = len(data)-2
+    if ignore_first_seconds_external:
+        start_index = ignore_first_seconds_external*sf_external
+    if consider_first_seconds_external:
+        stop_index = consider_first_seconds_external*sf_external
+    if abs(max(data)) > abs(min(data)):
+        data = data * -1
+
+    for q in range(start_index,stop_index):
+        if ((stimON == False)
+                and (data[q] <= thresh_BIP)
+                and (data[q] < data[q + 1])
+                and (data[q] < data[q - 1])):
+            if q >= 0.2*sf_external:
+                index_artefact_start_external.append(q)
+                stimON = True
+                q = q + 1
+            elif q < 0.2*sf_external:
+                stimON = True
+                q = q + 1
+        if (stimON
+                and (data[q] <= thresh_BIP)
+                and (data[q] < data[q + 1])
+                and (data[q] < data[q - 1])):
+            if (all(data[(q + 2):(q + int(0.5*sf_external))] > thresh_BIP)):
+                stimON = False
+                q = q + 1
+        else:
+            q = q + 1
+
+    if consider_first_seconds_external:
+        for q in range(len(data) - stop_index, len(data) - 2):
+            if (not stimON
+                    and (data[q] <= thresh_BIP)
+                    and (data[q] < data[q + 1])
+                    and (data[q] < data[q - 1])):
+                index_artefact_start_external.append(q)
+                stimON = True
+                q = q + 1
+            if (stimON
+                    and (data[q] <= thresh_BIP)
+                    and (data[q] < data[q + 1])
+                    and (data[q] < data[q - 1])):
+                if (all(data[(q + 2):(q + int(0.5*sf_external))] > thresh_BIP)):
+                    stimON = False
+                    q = q + 1
+            else:
+                q = q + 1
+
+    return index_artefact_start_external
+
+
+
+def _synthetic_bip(seed, duration=60, sf=SF_EXTERNAL):
+    """
+    Noise with trains of stimulation pulses of random length (including
+    single pulses) at random times
+    """
+
+    rng = np.random.default_rng(seed)
+    data = rng.standard_normal(sf*duration)*1e-4
+    t = rng.uniform(0.5, 3)
+    while t < duration - 1:
+        n_pulses = rng.choice([1, 1, 2, 5, 50, 300])
+        for i in int(t*sf) + np.arange(n_pulses)*int(sf/130):
+            if i + 6 >= len(data):
+                break
+            data[i:i+3] += np.array([-0.004, -0.006, -0.002]) * (1 + 0.1*rng.standard_normal())
+            data[i+3:i+6] += 0.0005
+        t += n_pulses/130 + rng.uniform(0.2, 4)
+
+    return data
+
+
+
+@pytest.fixture
+def config_dir(tmp_path, monkeypatch):
+    (tmp_path / 'config').mkdir()
+    with open(tmp_path / 'config' / 'config.json', 'w') as f:
+        json.dump({'thresh_external': THRESH_BIP}, f)
+    monkeypatch.chdir(tmp_path)
+
+
+
+@pytest.mark.parametrize('seed', range(10))
+@pytest.mark.parametrize('options', [
+    {},
+    {'ignore_first_seconds_external': 3},
+    {'consider_first_seconds_external': 20},
+])
+@pytest.mark.parametrize('inverted', [False, True])
+def test_same_artefacts_as_baseline_loop(config_dir, seed, options, inverted):
+    data = _synthetic_bip(seed)
+    if inverted:
+        data = data * -1
+
+    expected = _baseline_find_external_sync_artefact(data, SF_EXTERNAL, **options)
+    for coarse_to_fine in (False, True):
+        assert find_external_sync_artefact(
+            data, SF_EXTERNAL, coarse_to_fine=coarse_to_fine, **options
+        ) == expected
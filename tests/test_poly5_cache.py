@@ -0,0 +1,69 @@
+"""
+Check that a recording loaded a second time with cache_dir set in the
+config comes from the decoded-data cache, with the same samples
+"""
+
+import json
+import struct
+
+import numpy as np
+import pytest
+
+from functions.loading_data import _load_TMSi_artefact_channel
+
+
+SF_EXTERNAL = 4000
+CH_NAMES = ['BIP 01', 'EMG 01']
+
+
+
+def _write_poly5(path, data, sf=SF_EXTERNAL, samples_per_block=100):
+    """ Minimal Poly5 (version 2.03) file with microvolt channels """
+
+    n_channels, n_samples = data.shape
+    n_blocks = -(-n_samples // samples_per_block)
+    header = struct.pack(
+        "=31sH81phhBHi4xHHHHHHHiHHH64x",
+        b'POLY SAMPLE FILEversion 2.03\r\n\x1a', 203, b'test', sf, sf, 0,
+        n_channels*2, n_samples, 2023, 5, 23, 2, 11, 39, 52,
+        n_blocks, samples_per_block, samples_per_block*n_channels*4, 0
+    )
+    content = [header]
+    for name in CH_NAMES[:n_channels]:
+        description = struct.pack(
+            "=41p4x11pffffH62x", b'(Lo) ' + name.encode('ascii'),
+            'µVolt'.encode('utf-8'), 0, 1, 0, 1, 0
+        )
+        content += [description, description]
+    for b in range(n_blocks):
+        block = data[:, b*samples_per_block:(b + 1)*samples_per_block]
+        content += [b'\0'*86, block.T.astype('<f4').tobytes()]
+    path.write_bytes(b''.join(content))
+
+
+
+@pytest.fixture
+def config_dir(tmp_path, monkeypatch):
+    (tmp_path / 'config').mkdir()
+    with open(tmp_path / 'config' / 'config.json', 'w') as f:
+        json.dump({'ch_name_BIP': 'BIP 01', 'cache_dir': str(tmp_path / 'cache')}, f)
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+
+def test_second_load_comes_from_cache(config_dir, capsys):
+    data = np.random.default_rng(0).standard_normal((2, 1050)) * 100
+    poly5_path = config_dir / 'rec.Poly5'
+    _write_poly5(poly5_path, data)
+
+    first = _load_TMSi_artefact_channel(str(poly5_path), toMNE=False)
+    assert 'Data loaded from cache.' not in capsys.readouterr().out
+    assert any((config_dir / 'cache').iterdir())
+
+    second = _load_TMSi_artefact_channel(str(poly5_path), toMNE=False)
+    assert 'Data loaded from cache.' in capsys.readouterr().out
+
+    np.testing.assert_allclose(first[1], data * 1e-6, rtol=1e-6)
+    np.testing.assert_array_equal(first[1], second[1])
+    assert first[2:] == second[2:]